@@ -0,0 +1,127 @@
+import copy
+import hashlib
+from collections import OrderedDict
+
+from scrapy.http import TextResponse, XmlResponse
+from scrapy.selector import Selector
+
+
+class SelectorCache:
+    """
+    Keeps the parsed documents of the responses played back recently, so
+    playing the same response again doesn't parse it again.
+
+    Entries are looked up by a hash of the response body and the least
+    recently used ones are dropped once their bodies add up to more than
+    `max_size` bytes.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def _key(self, response):
+        digest = hashlib.sha1(response.body).hexdigest()
+        return digest, type(response), response.url, response.encoding
+
+    def _selector(self, response):
+        # Built from the text so cached selectors don't keep the response,
+        # and the spider it was played back with, alive
+        return Selector(
+            text=response.text,
+            type='xml' if isinstance(response, XmlResponse) else 'html',
+            base_url=response.url,
+        )
+
+    def attach(self, response):
+        if not isinstance(response, TextResponse) or len(response.body) > self.max_size:
+            return
+        key = self._key(response)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = (self._selector(response), len(response.body))
+            self.size += entry[1]
+            while self.size > self.max_size:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.size -= size
+        else:
+            self.hits += 1
+        self.entries[key] = entry
+        response._cached_selector = entry[0]
+
+
+class LinkCache:
+    """
+    Keeps the links extracted from the responses played back recently by
+    CrawlSpider rules, so extracting them again is skipped.
+
+    Entries are looked up by extractor and a hash of the response body,
+    and the least recently used ones are dropped once there are more
+    than `max_entries`.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def extract_links(self, extractor, response):
+        digest = hashlib.sha1(response.body).hexdigest()
+        key = id(extractor), digest, type(response), response.url, response.encoding
+        entry = self.entries.pop(key, None)
+        # Entries keep their extractor, so one from a reloaded spider
+        # that got the same id isn't mistaken for it
+        if entry is None or entry[0] is not extractor:
+            self.misses += 1
+            entry = (extractor, extractor.extract_links(response))
+            while len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+        self.entries[key] = entry
+        # Rules may change the links they are given
+        return [copy.copy(link) for link in entry[1]]
+
+
+class CachedLinkExtractor:
+    def __init__(self, extractor, cache):
+        self.extractor = extractor
+        self.cache = cache
+
+    def extract_links(self, response):
+        return self.cache.extract_links(self.extractor, response)
+
+
+_selector_cache = None
+_link_cache = None
+_selector_cache_supported = []
+
+
+def _supports_selector_cache():
+    # Selectors are handed to responses through a Scrapy internal, the
+    # cache is off with the Scrapy versions that don't have it
+    if not _selector_cache_supported:
+        response = TextResponse('http://localhost', body=b'', encoding='utf-8')
+        _selector_cache_supported.append(hasattr(response, '_cached_selector'))
+    return _selector_cache_supported[0]
+
+
+def get_selector_cache(max_size):
+    global _selector_cache
+    if not max_size or not _supports_selector_cache():
+        return None
+    if _selector_cache is None or _selector_cache.max_size != max_size:
+        _selector_cache = SelectorCache(max_size)
+    return _selector_cache
+
+
+def get_link_cache(max_entries):
+    global _link_cache
+    if not max_entries:
+        return None
+    if _link_cache is None or _link_cache.max_entries != max_entries:
+        _link_cache = LinkCache(max_entries)
+    return _link_cache
@@ -1,14 +1,33 @@
+import copy
+import os
 import pickle
 import sys
 import zlib
 
-from scrapy.crawler import Crawler
-from scrapy.utils.conf import build_component_list
-from scrapy.utils.project import get_project_settings
-
 from .utils import get_spider_class
 
 
+# Pickled cassettes with response bodies at least this big keep the body
+# in a section of its own, compressed a chunk at a time
+SECTIONED_BODY_SIZE = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+SECTIONS_MAGIC = b'AUTOUNIT SECTIONS 1\n'
+
+# Whether pickle fixtures can be loaded, read once from the project settings
+_allow_pickle = []
+
+
+def check_pickle_allowed():
+    if not _allow_pickle:
+        from scrapy.utils.project import get_project_settings
+
+        _allow_pickle.append(get_project_settings().getbool('AUTOUNIT_ALLOW_PICKLE', True))
+    if not _allow_pickle[0]:
+        raise ValueError(
+            "Loading pickle fixtures is disabled by AUTOUNIT_ALLOW_PICKLE, "
+            "convert them with `autounit convert --to json`")
+
+
 class Cassette:
     """
     Helper class to store request, response and output data.
@@ -29,6 +48,9 @@ class Cassette:
         included_settings=None,
         python_version=None,
         filename=None,
+        fingerprint=None,
+        rule=None,
+        clock=None,
     ):
         self.spider_name = spider_name
         self.middlewares = middlewares
@@ -45,16 +67,61 @@ class Cassette:
         self.output_attrs = output_attrs
         self.output_data = output_data
         self.filename = filename
+        self.fingerprint = fingerprint
+        self.rule = rule
+        self.clock = clock
         self.python_version = python_version or sys.version_info.major
+        self.serialization = 'pickle'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The filename is taken from the fixture path when loading it, so
+        # identical cassettes are packed into identical fixtures
+        state.pop('filename', None)
+        state.pop('serialization', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('filename', None)
+        self.__dict__.setdefault('fingerprint', None)
+        self.__dict__.setdefault('rule', None)
+        self.__dict__.setdefault('clock', None)
+        self.__dict__.setdefault('serialization', 'pickle')
+
+    @classmethod
+    def unpack(cls, data):
+        if data.startswith(SECTIONS_MAGIC):
+            check_pickle_allowed()
+            # The compressed body is followed by the rest of the cassette
+            decompressor = zlib.decompressobj()
+            body = decompressor.decompress(memoryview(data)[len(SECTIONS_MAGIC):])
+            cassette = pickle.loads(zlib.decompress(decompressor.unused_data))
+            cassette.response['body'] = body
+            return cassette
+        data = zlib.decompress(data)
+        if not data.startswith(b'{'):
+            check_pickle_allowed()
+            return pickle.loads(data)
+        from . import serialization
+
+        cassette = cls.__new__(cls)
+        cassette.__setstate__(serialization.loads(data))
+        cassette.serialization = 'json'
+        return cassette
 
     @classmethod
     def from_fixture(cls, fixture):
-        with open(fixture, 'rb') as f:
-            binary = f.read()
-        cassette = pickle.loads(zlib.decompress(binary))
+        from .storage import read_fixture
+
+        cassette = cls.unpack(read_fixture(fixture))
+        if isinstance(cassette, Cassette):
+            cassette.filename = os.path.basename(fixture)
         return cassette
 
     def _get_middlewares(self, settings):
+        from scrapy.utils.conf import build_component_list
+
         full_list = build_component_list(settings.getwithbase('SPIDER_MIDDLEWARES'))
         autounit_mw_path = list(filter(lambda x: x.endswith('AutounitMiddleware'), full_list))[0]
         start = full_list.index(autounit_mw_path)
@@ -69,9 +136,18 @@ class Cassette:
         included = {name: settings.get(name) for name in names}
         return included
 
-    def get_spider(self):
-        settings = get_project_settings()
-        spider_cls = get_spider_class(self.spider_name, settings)
+    def get_spider(self, spider_cls=None, settings=None):
+        # Callers replaying many fixtures can pass already loaded project
+        # settings and spider class to avoid looking them up every time
+        from scrapy.crawler import Crawler
+        from scrapy.utils.project import get_project_settings
+
+        if settings is None:
+            settings = get_project_settings()
+        else:
+            settings = settings.copy()
+        if spider_cls is None:
+            spider_cls = get_spider_class(self.spider_name, settings)
 
         spider_cls.update_settings(settings)
         for k, v in self.included_settings.items():
@@ -81,8 +157,38 @@ class Cassette:
         spider = spider_cls.from_crawler(crawler, **self.init_attrs)
         return spider
 
-    def pack(self):
-        return zlib.compress(pickle.dumps(self, protocol=2))
+    def pack(self, serialization=None):
+        return b''.join(self.pack_chunks(serialization))
+
+    def pack_chunks(self, serialization=None):
+        """
+        Return the packed cassette as an iterator of chunks. Big response
+        bodies are compressed a chunk at a time while the chunks are
+        consumed, so they are never copied whole.
+        """
+        # Fixtures keep the format they were loaded from unless told otherwise
+        if (serialization or self.serialization) == 'json':
+            from . import serialization as json_serialization
+
+            return iter([zlib.compress(json_serialization.dumps(self.__getstate__()))])
+        body = (self.response or {}).get('body') or b''
+        if len(body) < SECTIONED_BODY_SIZE:
+            return iter([zlib.compress(pickle.dumps(self, protocol=2))])
+        # Everything but the body is pickled right away, so errors are
+        # raised before any chunk is written
+        rest = copy.copy(self)
+        rest.response = dict(self.response, body=b'')
+        return self._iter_sections(body, zlib.compress(pickle.dumps(rest, protocol=2)))
+
+    @staticmethod
+    def _iter_sections(body, rest):
+        yield SECTIONS_MAGIC
+        compressor = zlib.compressobj()
+        view = memoryview(body)
+        for start in range(0, len(view), CHUNK_SIZE):
+            yield compressor.compress(view[start:start + CHUNK_SIZE])
+        yield compressor.flush()
+        yield rest
 
     def to_dict(self):
         return {
@@ -95,4 +201,6 @@ class Cassette:
             'init_attrs': self.init_attrs,
             'input_attrs': self.input_attrs,
             'output_attrs': self.output_attrs,
+            'rule': self.rule,
+            'clock': self.clock,
         }
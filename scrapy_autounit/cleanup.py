@@ -0,0 +1,180 @@
+import hashlib
+import os
+import re
+from itertools import islice
+
+from scrapy.commands.genspider import sanitize_module_name
+from scrapy.utils.misc import walk_modules
+from scrapy.utils.spider import iter_spider_classes
+
+from .manifest import Manifest
+from .storage import (
+    PACK_FILENAME, clear_fixtures, compact, delete_fixture, fixture_size, list_fixtures,
+    read_fixture,
+)
+
+
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(value):
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$', value, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size '{}', expected e.g. '500k' or '2G'".format(value))
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def _fixture_order(path):
+    # fixture2.bin comes before fixture10.bin
+    name = os.path.basename(path)
+    return len(name), name
+
+
+class Collector:
+    """
+    Finds the fixtures that can be removed: the ones of spiders and
+    callbacks that no longer exist, duplicates (with the same data, or
+    with `same_request` also for the same request), fixtures bigger than
+    `max_size` and, while the fixtures of a spider or of the whole project
+    take more than their budget, the biggest fixtures of the callbacks
+    that have more than one.
+
+    Fixtures are compared by size and only read when another fixture of
+    the same callback has the same size, and duplicated requests are
+    found through the manifest, so fixtures are never unpickled.
+    """
+    def __init__(
+        self, settings, base_path, max_size=None, budget=None, spider_budget=None,
+        same_request=False,
+    ):
+        self.settings = settings
+        self.base_path = base_path
+        self.tests_dir = os.path.join(base_path, 'tests')
+        self.max_size = max_size
+        self.budget = budget
+        self.spider_budget = spider_budget
+        # Fingerprints leave out meta, spider attributes and the response,
+        # so fixtures of the same request may still test different things
+        self.same_request = same_request
+        self.manifest = Manifest(base_path)
+
+    def _get_spider_classes(self):
+        spider_classes = {}
+        for spider_module in self.settings.getlist('SPIDER_MODULES'):
+            for module in islice(walk_modules(spider_module), 1, None):
+                for spider_class in iter_spider_classes(module):
+                    spider_classes[sanitize_module_name(spider_class.name)] = spider_class
+        return spider_classes
+
+    def _get_fixtures(self, spiders=None):
+        # Fixtures of each callback directory, by spider directory
+        fixtures = {}
+        for root, _, _ in os.walk(self.tests_dir):
+            spider = os.path.relpath(root, self.tests_dir).split(os.sep)[0]
+            if spiders and spider not in spiders:
+                continue
+            paths = list_fixtures(root)
+            if paths:
+                sizes = [(path, fixture_size(path)) for path in sorted(paths, key=_fixture_order)]
+                fixtures.setdefault(spider, {})[root] = sizes
+        return fixtures
+
+    def _find_duplicates(self, sizes):
+        by_size = {}
+        for path, size in sizes:
+            by_size.setdefault(size, []).append(path)
+        seen_digests = set()
+        seen_requests = set()
+        for path, size in sizes:
+            entry = self.manifest.fixtures.get(self.manifest.get_key(path)) or {}
+            request = entry.get('fingerprint') if self.same_request else None
+            if request is not None:
+                if request in seen_requests:
+                    yield path, size, 'same request'
+                    continue
+                seen_requests.add(request)
+            if len(by_size[size]) > 1:
+                digest = hashlib.sha1(read_fixture(path)).hexdigest()
+                if digest in seen_digests:
+                    yield path, size, 'same data'
+                    continue
+                seen_digests.add(digest)
+
+    def _over_budget(self, callbacks, budget):
+        kept = dict((callback_dir, list(sizes)) for callback_dir, sizes in callbacks.items())
+        total = sum(size for sizes in kept.values() for _, size in sizes)
+        candidates = sorted(
+            ((size, path, callback_dir)
+             for callback_dir, sizes in kept.items() for path, size in sizes),
+            key=lambda x: (-x[0], x[1]))
+        for size, path, callback_dir in candidates:
+            if total <= budget:
+                break
+            # Every callback keeps at least one fixture
+            if len(kept[callback_dir]) < 2:
+                continue
+            kept[callback_dir].remove((path, size))
+            total -= size
+            yield path, size, 'over budget'
+
+    def collect(self, spiders=None):
+        """
+        Return the (reason, path, size) of what can be removed, where path
+        is a spider or callback directory for the ones that no longer
+        exist and a fixture otherwise.
+        """
+        spider_classes = self._get_spider_classes()
+        garbage = []
+        remaining = {}
+        for spider, callbacks in sorted(self._get_fixtures(spiders).items()):
+            spider_cls = spider_classes.get(spider)
+            if spider_cls is None:
+                size = sum(size for sizes in callbacks.values() for _, size in sizes)
+                garbage.append(('orphaned spider', os.path.join(self.tests_dir, spider), size))
+                continue
+            for callback_dir, sizes in sorted(callbacks.items()):
+                if not hasattr(spider_cls, os.path.basename(callback_dir)):
+                    size = sum(size for _, size in sizes)
+                    garbage.append(('orphaned callback', callback_dir, size))
+                    continue
+                removed = set()
+                for path, size, reason in self._find_duplicates(sizes):
+                    garbage.append(('duplicate ({})'.format(reason), path, size))
+                    removed.add(path)
+                if self.max_size:
+                    for path, size in sizes:
+                        if size > self.max_size and path not in removed:
+                            garbage.append(('oversized', path, size))
+                            removed.add(path)
+                kept = [(path, size) for path, size in sizes if path not in removed]
+                if kept:
+                    remaining.setdefault(spider, {})[callback_dir] = kept
+
+        if self.spider_budget:
+            for spider, callbacks in sorted(remaining.items()):
+                for path, size, reason in self._over_budget(callbacks, self.spider_budget):
+                    garbage.append((reason, path, size))
+                    callbacks[os.path.dirname(path)].remove((path, size))
+        if self.budget:
+            all_callbacks = {}
+            for callbacks in remaining.values():
+                all_callbacks.update(callbacks)
+            for path, size, reason in self._over_budget(all_callbacks, self.budget):
+                garbage.append((reason, path, size))
+        return garbage
+
+    def remove(self, garbage):
+        callback_dirs = set()
+        for reason, path, size in garbage:
+            if reason.startswith('orphaned'):
+                clear_fixtures(path)
+                self.manifest.discard(path)
+            else:
+                delete_fixture(path)
+                self.manifest.remove(path)
+                callback_dirs.add(os.path.dirname(path))
+        # Space taken by fixtures removed from packs is only freed by compacting
+        for callback_dir in callback_dirs:
+            if os.path.isfile(os.path.join(callback_dir, PACK_FILENAME)):
+                compact(callback_dir)
+        self.manifest.save()
@@ -1,21 +1,75 @@
 import argparse
 import json
 import os
-import pickle
 import re
 import sys
-from datetime import datetime
-from glob import glob
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
 
-import scrapy
 from scrapy.commands.genspider import sanitize_module_name
 from scrapy.utils.project import inside_project, get_project_settings
-from scrapy.utils.python import to_unicode
 
 from .cassette import Cassette
-from .player import Player
-from .recorder import Recorder, TEST_TEMPLATE
-from .utils import get_base_path, get_project_dir
+from .manifest import Manifest
+from .migrate import from_legacy_fixture, update_legacy_test
+from .storage import (
+    FORMATS, compact, fixture_exists, get_database, get_format, list_fixtures, open_database,
+    write_fixture,
+)
+from .timings import Timings, parse_duration
+from .utils import get_base_path, get_project_dir, parse_data
+
+
+def parse_fields(fields):
+    # 'output_data[*].type' -> ['output_data', '*', 'type']
+    parsed = []
+    for field in fields or []:
+        tokens = []
+        for part in field.split('.'):
+            match = re.match(r'^([^\[\]]*)((?:\[(?:\*|\d+)\])*)$', part)
+            if not match:
+                raise ValueError("Invalid field '{}'".format(field))
+            if match.group(1):
+                tokens.append(match.group(1))
+            for index in re.findall(r'\[(\*|\d+)\]', match.group(2)):
+                tokens.append(index if index == '*' else int(index))
+        parsed.append((field, tokens))
+    return parsed
+
+
+def _extract(data, tokens):
+    if not tokens:
+        return data
+    token, rest = tokens[0], tokens[1:]
+    if token == '*':
+        if not isinstance(data, (list, tuple)):
+            return None
+        return [_extract(x, rest) for x in data]
+    if isinstance(token, int):
+        if not isinstance(data, (list, tuple)) or token >= len(data):
+            return None
+        return _extract(data[token], rest)
+    if not hasattr(data, 'keys') or token not in data:
+        return None
+    return _extract(data[token], rest)
+
+
+def _inspect_fixture(task):
+    path, fields, batch = task
+    cassette = Cassette.from_fixture(path)
+    if not isinstance(cassette, Cassette):
+        data = {'error': 'Legacy fixture, run `autounit update` first'}
+    elif fields:
+        # Only the selected fields are converted, so bodies
+        # aren't decoded unless they are asked for
+        data = cassette.to_dict()
+        data = {field: parse_data(_extract(data, tokens)) for field, tokens in fields}
+    else:
+        data = parse_data(cassette.to_dict())
+    if batch:
+        data['fixture'] = os.path.relpath(path)
+    return json.dumps(data)
 
 
 class CommandLine:
@@ -28,17 +82,17 @@ class CommandLine:
 
         self.command = self.args.command
 
-        self.spider = self.args.spider
-        self.callback = self.args.callback
-        self.fixture = self.args.fixture
+        self.spider = getattr(self.args, 'spider', None)
+        self.callback = getattr(self.args, 'callback', None)
+        self.fixture = getattr(self.args, 'fixture', None)
 
         self.project_dir = get_project_dir()
         sys.path.append(self.project_dir)
 
         self.settings = get_project_settings()
 
-        base_path = get_base_path(self.settings)
-        self.tests_dir = os.path.join(base_path, 'tests')
+        self.base_path = get_base_path(self.settings)
+        self.tests_dir = os.path.join(self.base_path, 'tests')
 
         if self.spider:
             self.spider = sanitize_module_name(self.spider)
@@ -55,7 +109,7 @@ class CommandLine:
 
                 if self.fixture:
                     self.fixture_path = os.path.join(self.callback_dir, self.parse_fixture_arg())
-                    if not os.path.isfile(self.fixture_path):
+                    if not fixture_exists(self.fixture_path):
                         self._error("Fixture '{}' not found".format(self.fixture_path))
 
     def _error(self, msg):
@@ -76,52 +130,9 @@ class CommandLine:
     def _get_spider_fixtures(self, callbacks_dir):
         fixtures = []
         for callback in self._walk(callbacks_dir):
-            target = os.path.join(callbacks_dir, callback, '*.bin')
-            fixtures.extend(glob(target))
+            fixtures.extend(list_fixtures(os.path.join(callbacks_dir, callback)))
         return fixtures
 
-    def _from_legacy_fixture(self, recorded):
-        encoding = recorded.get('encoding', 'utf-8')
-        data = recorded.get('data')
-        old = recorded if not data else pickle.loads(data, encoding=encoding)
-        return Cassette(
-            spider_name=old['spider_name'],
-            request=old['request'],
-            response=old['response'],
-            init_attrs={},
-            input_attrs=old.get('spider_args_in') or old.get('spider_args') or {},
-            output_attrs=old.get('spider_args_out', {}),
-            output_data=old['result'],
-            middlewares=old['middlewares'],
-            included_settings=old['settings'],
-            python_version=old.get('python_version', sys.version_info.major),
-        )
-
-    def _update_legacy_test(self, path, cassette):
-        path_dir = os.path.dirname(path)
-        older_version_test = os.path.join(path_dir, 'test_fixture1.py')
-        if os.path.isfile(older_version_test):
-            to_remove = os.path.join(path_dir, 'test_fixture*.py')
-            for test in glob(to_remove):
-                if test == older_version_test:
-                    os.rename(test, path)
-                    continue
-                os.remove(test)
-        test_name = (
-            sanitize_module_name(cassette.spider_name) + '__' +
-            cassette.request['callback']
-        )
-        with open(path, 'r+') as f:
-            old = f.read()
-            command = 'Scrapy Autounit'
-            command_re = re.search('# Generated by: (.*)  # noqa', old)
-            if command_re:
-                command = command_re.group(1)
-            test_code = TEST_TEMPLATE.format(test_name=test_name, command=command)
-            f.seek(0)
-            f.write(test_code)
-            f.truncate()
-
     def parse_fixture_arg(self):
         try:
             int(self.fixture)
@@ -133,33 +144,67 @@ class CommandLine:
         return self.fixture
 
     def parse_data(self, data):
-        if isinstance(data, (dict, scrapy.Item)):
-            return {
-                self.parse_data(k): self.parse_data(v)
-                for k, v in data.items()
-            }
-        elif isinstance(data, list):
-            return [self.parse_data(x) for x in data]
-        elif isinstance(data, bytes):
-            return to_unicode(data)
-        elif isinstance(data, datetime):
-            return data.isoformat()
-        elif isinstance(data, (int, float, str)):
-            return data
-        return repr(data)
+        return parse_data(data)
 
     def inspect(self):
-        cassette = Cassette.from_fixture(self.fixture_path)
-        data = self.parse_data(cassette.to_dict())
-        print(json.dumps(data))
+        if not self._check_scope():
+            return
 
-    def update(self):
+        try:
+            fields = parse_fields(self.args.fields)
+        except ValueError as e:
+            self._error(str(e))
+        if self.fixture:
+            print(_inspect_fixture((self.fixture_path, fields, False)))
+            return
+
+        tasks = [(path, fields, True) for path in self._get_fixtures()]
+        jobs = self.args.jobs or cpu_count()
+        if jobs == 1 or len(tasks) < 2:
+            lines = map(_inspect_fixture, tasks)
+            pool = None
+        else:
+            pool = Pool(jobs)
+            lines = pool.imap(_inspect_fixture, tasks, chunksize=4)
+        try:
+            for line in lines:
+                print(line)
+                sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _check_scope(self):
         if self.callback and not self.spider:
             print("Must specify a spider")
-            return
+            return False
 
         if self.fixture and (not self.spider or not self.callback):
             print("Must specify a spider and a callback")
+            return False
+
+        return True
+
+    def _get_fixtures(self):
+        fixtures = []
+        if self.fixture:
+            fixtures.append(self.fixture_path)
+        elif self.callback:
+            fixtures = list_fixtures(self.callback_dir)
+        elif self.spider:
+            fixtures = self._get_spider_fixtures(self.callbacks_dir)
+        else:
+            for spider in self._walk(self.tests_dir):
+                callbacks_dir = self._get_callbacks_dir(spider)
+                fixtures.extend(self._get_spider_fixtures(callbacks_dir))
+        return sorted(fixtures)
+
+    def update(self):
+        from .player import Player
+        from .recorder import Recorder
+
+        if not self._check_scope():
             return
 
         if not self.spider:
@@ -169,18 +214,8 @@ class CommandLine:
                 print("Update cancelled")
                 return
 
-        to_update = []
-        if self.fixture:
-            to_update.append(self.fixture_path)
-        elif self.callback:
-            target = os.path.join(self.callback_dir, "*.bin")
-            to_update = glob(target)
-        elif self.spider:
-            to_update = self._get_spider_fixtures(self.callbacks_dir)
-        else:
-            for spider in self._walk(self.tests_dir):
-                callbacks_dir = self._get_callbacks_dir(spider)
-                to_update.extend(self._get_spider_fixtures(callbacks_dir))
+        to_update = self._get_fixtures()
+        manifest = Manifest(self.base_path)
 
         for path in to_update:
             player = Player.from_fixture(path)
@@ -188,10 +223,10 @@ class CommandLine:
             # Convert legacy fixtures to new cassette-based fixtures
             if isinstance(player.cassette, dict):
                 print("Converting legacy fixture: {}".format(path))
-                new_cassette = self._from_legacy_fixture(player.cassette)
+                new_cassette = from_legacy_fixture(player.cassette)
                 player.cassette = new_cassette
                 test_path = os.path.join(os.path.dirname(path), 'test_fixtures.py')
-                self._update_legacy_test(test_path, new_cassette)
+                update_legacy_test(test_path, new_cassette)
 
             output, attrs = player.playback(compare=False)
 
@@ -204,15 +239,312 @@ class CommandLine:
             cassette.output_attrs = attrs['output']
 
             Recorder.update_fixture(cassette, path)
+            manifest.add(path, cassette)
 
             print("Fixture '{}' successfully updated.".format(
                 os.path.relpath(path)))
 
+        manifest.save()
+
+    def serve(self):
+        from .runner import Runner, serve
+
+        serve(Runner(self.settings))
+
+    def play(self):
+        from . import runner
+
+        if not self._check_scope():
+            return
+
+        conn = runner.connect(self.base_path)
+        if self.args.stop:
+            if conn is None:
+                self._error("No running server found")
+            runner.send(conn, {'command': 'stop'})
+            return
+
+        fixtures = self._get_fixtures()
+        if self.args.budget:
+            try:
+                budget = parse_duration(self.args.budget)
+            except ValueError as e:
+                self._error(str(e))
+            selected, estimate = Timings(self.base_path).select(
+                fixtures, budget, self.args.jobs or 1)
+            print("Playing {} of {} fixture(s), estimated {:.1f}s".format(
+                len(selected), len(fixtures), estimate))
+            fixtures = selected
+        self._play(fixtures, conn, jobs=self.args.jobs)
+
+    def _play(self, fixtures, conn=None, jobs=None):
+        from . import runner
+
+        fixtures = [os.path.abspath(path) for path in fixtures]
+        if jobs and jobs > 1 and len(fixtures) > 1:
+            if conn is not None:
+                conn.close()
+            results = runner.run_parallel(fixtures, jobs)
+        elif conn is not None:
+            results = runner.send(conn, {'fixtures': fixtures})
+        else:
+            local = runner.Runner(self.settings)
+            results = [local.run(path) for path in fixtures]
+
+        Timings(self.base_path).update(results)
+        if self._report(results):
+            sys.exit(1)
+
+    def _report(self, results):
+        failed = 0
+        for result in results:
+            print("{} {} ({:.3f}s)".format(
+                result['status'].upper(), os.path.relpath(result['fixture']), result['duration']))
+            if result['message']:
+                print(result['message'])
+            if result['status'] != 'passed':
+                failed += 1
+        print("Played {} fixture(s), {} failed".format(len(results), failed))
+        return failed
+
+    def watch(self):
+        from .runner import Runner, Watcher
+
+        runner = Runner(self.settings)
+        watcher = Watcher(runner)
+        print("Watching for changes, press Ctrl+C to stop")
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(self.args.interval)
+                try:
+                    changed, fixtures = watcher.poll()
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                if changed:
+                    print("Reloaded: {}".format(', '.join(changed)))
+                    self._report([runner.run(path) for path in fixtures])
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+
+    def impact(self):
+        from . import runner
+
+        if not self._check_scope():
+            return
+        if not (self.args.middleware or self.args.setting or self.args.callbacks):
+            self._error("Must specify a middleware, a setting or a callback")
+
+        manifest = Manifest(self.base_path)
+        keys = []
+        for path in self._get_fixtures():
+            key = manifest.get_key(path)
+            entry = manifest.fixtures.get(key)
+            if entry is None or 'middlewares' not in entry:
+                # Fixtures recorded before the manifest listed their
+                # middlewares and settings are read once to add them
+                cassette = Cassette.from_fixture(path)
+                if not isinstance(cassette, Cassette):
+                    sys.stderr.write(
+                        "Skipping legacy fixture '{}', run `autounit update` first\n".format(
+                            os.path.relpath(path)))
+                    continue
+                manifest.add(path, cassette)
+            keys.append(key)
+        manifest.save()
+
+        found = manifest.find(
+            middlewares=self.args.middleware or (),
+            settings=self.args.setting or (),
+            callbacks=self.args.callbacks or (),
+            keys=keys,
+        )
+        fixtures = sorted(manifest.get_path(key) for key in found)
+        if self.args.play:
+            self._play(fixtures, runner.connect(self.base_path))
+            return
+        for path in fixtures:
+            print(os.path.relpath(path))
+
+    def _get_callback_dirs(self):
+        if self.callback:
+            return [self.callback_dir]
+        spiders = [self.spider] if self.spider else list(self._walk(self.tests_dir))
+        callback_dirs = set()
+        for spider in spiders:
+            callbacks_dir = self._get_callbacks_dir(spider)
+            for callback in self._walk(callbacks_dir):
+                callback_dir = os.path.join(callbacks_dir, callback)
+                if os.path.isdir(callback_dir):
+                    callback_dirs.add(callback_dir)
+        return sorted(callback_dirs)
+
+    def compact(self):
+        if not self._check_scope():
+            return
+
+        fixture_format = self.args.format or get_format(self.settings)
+        if fixture_format == 'sqlite':
+            open_database(self.base_path)
+        for callback_dir in self._get_callback_dirs():
+            compact(callback_dir, fixture_format)
+            print("Compacted '{}'".format(os.path.relpath(callback_dir)))
+
+    def convert(self):
+        from .serialization import get_serialization
+
+        if not self._check_scope():
+            return
+
+        serialization = self.args.to or get_serialization(self.settings)
+        for path in self._get_fixtures():
+            cassette = Cassette.from_fixture(path)
+            if not isinstance(cassette, Cassette):
+                print("Skipping legacy fixture '{}', run `autounit update` first".format(
+                    os.path.relpath(path)))
+                continue
+            if cassette.serialization == serialization:
+                continue
+            write_fixture(path, cassette.pack_chunks(serialization), cassette=cassette)
+            print("Fixture '{}' converted to {}.".format(os.path.relpath(path), serialization))
+
+    def query(self):
+        if not self._check_scope():
+            return
+
+        database = get_database(self.base_path)
+        if database is None:
+            self._error(
+                "No fixtures database found, record with AUTOUNIT_FIXTURE_FORMAT = 'sqlite' "
+                "or run `autounit compact --format sqlite`")
+        path = None
+        if self.callback:
+            path = self.callback_dir
+        elif self.spider:
+            path = self.callbacks_dir
+        for fixture in database.query(path, where=self.args.where):
+            fixture['path'] = os.path.relpath(fixture['path'])
+            print(json.dumps(fixture))
+
+    def _get_recording(self, path):
+        # Either an autounit directory or its tests directory
+        path = os.path.abspath(path)
+        if os.path.basename(path) == 'tests':
+            path = os.path.dirname(path)
+        if not os.path.isdir(os.path.join(path, 'tests')):
+            self._error("No recorded data found in '{}'".format(path))
+        return path
+
+    def diff(self):
+        from .diff import Differ
+
+        base_a = self._get_recording(self.args.dir_a)
+        base_b = self._get_recording(self.args.dir_b)
+        result = Differ(base_a, base_b, jobs=self.args.jobs).diff()
+
+        for path_a, path_b, changes in result['changed']:
+            print("CHANGED {} {}".format(os.path.relpath(path_a), os.path.relpath(path_b)))
+            for change, path, old, new in changes:
+                if change == 'added':
+                    print("  + {}: {}".format(path, json.dumps(new)))
+                elif change == 'removed':
+                    print("  - {}: {}".format(path, json.dumps(old)))
+                else:
+                    print("  ~ {}: {} -> {}".format(path, json.dumps(old), json.dumps(new)))
+        for path in result['only_a']:
+            print("ONLY IN A {}".format(os.path.relpath(path)))
+        for path in result['only_b']:
+            print("ONLY IN B {}".format(os.path.relpath(path)))
+        print(
+            "{} identical, {} with the same output, {} changed, "
+            "{} only in A, {} only in B".format(
+                result['identical'], result['same_output'], len(result['changed']),
+                len(result['only_a']), len(result['only_b'])))
+        if result['changed'] or result['only_a'] or result['only_b']:
+            sys.exit(1)
+
+    def migrate(self):
+        from .migrate import Migrator
+        from .serialization import get_serialization
+
+        if not self._check_scope():
+            return
+
+        migrator = Migrator(
+            self.base_path, get_serialization(self.settings), jobs=self.args.jobs)
+        counts = {'migrated': 0, 'current': 0, 'error': 0}
+        for path, status, error in migrator.migrate(self._get_callback_dirs()):
+            counts[status] += 1
+            if status == 'migrated':
+                print("Fixture '{}' migrated.".format(os.path.relpath(path)))
+            elif status == 'error':
+                print("Fixture '{}' failed: {}".format(os.path.relpath(path), error))
+        print("Migrated {migrated} fixture(s), {current} already up to date, {error} failed".format(
+            **counts))
+        if counts['error']:
+            sys.exit(1)
+
+    def gc(self):
+        from .cleanup import Collector, parse_size
+
+        try:
+            sizes = [
+                parse_size(value) if value else None
+                for value in (self.args.max_size, self.args.budget, self.args.spider_budget)
+            ]
+        except ValueError as e:
+            self._error(str(e))
+        collector = Collector(
+            self.settings, self.base_path, *sizes, same_request=self.args.same_request)
+        garbage = collector.collect([self.spider] if self.spider else None)
+        for reason, path, size in garbage:
+            print("{} {} ({} bytes)".format(reason.upper(), os.path.relpath(path), size))
+        freed = sum(size for _, _, size in garbage)
+        if self.args.dry_run:
+            print("Would remove {} item(s), {} bytes".format(len(garbage), freed))
+            return
+        collector.remove(garbage)
+        print("Removed {} item(s), {} bytes".format(len(garbage), freed))
+
+    def merge(self):
+        from .merge import Merger
+
+        merger = Merger(self.settings, self.base_path, jobs=self.args.jobs)
+        if not merger.get_staged():
+            self._error("No staged recordings found")
+        stats = merger.merge(keep_staging=self.args.keep_staging)
+        print("Merged {recorded} fixture(s) from {processes} process(es), {kept} kept".format(
+            **stats))
+
     def parse_command(self):
         if self.command == "inspect":
             self.inspect()
         elif self.command == "update":
             self.update()
+        elif self.command == "serve":
+            self.serve()
+        elif self.command == "play":
+            self.play()
+        elif self.command == "watch":
+            self.watch()
+        elif self.command == "impact":
+            self.impact()
+        elif self.command == "merge":
+            self.merge()
+        elif self.command == "gc":
+            self.gc()
+        elif self.command == "migrate":
+            self.migrate()
+        elif self.command == "compact":
+            self.compact()
+        elif self.command == "query":
+            self.query()
+        elif self.command == "convert":
+            self.convert()
+        elif self.command == "diff":
+            self.diff()
 
 
 def main():
@@ -223,13 +555,25 @@ def main():
 
     inspect_cmd = subparsers.add_parser(
         'inspect',
-        description="Inspects fixtures data returning a JSON object",
+        description="Inspects fixtures data returning a JSON object per fixture",
         formatter_class=argparse.RawTextHelpFormatter)
-    inspect_cmd.add_argument('spider', help="The spider to update.")
-    inspect_cmd.add_argument('callback', help="The callback to update.")
-    inspect_cmd.add_argument('fixture', help=(
-        "The fixture to update.\n"
-        "Can be the fixture number or the fixture name."))
+    inspect_cmd.add_argument('spider', nargs='?', help=(
+        "The spider to inspect.\n"
+        "If not specified, all the spiders from the current project will be inspected."))
+    inspect_cmd.add_argument('callback', nargs='?', help=(
+        "The callback to inspect.\n"
+        "If not specified, all the callbacks from the specified spider will be inspected."))
+    inspect_cmd.add_argument('fixture', nargs='?', help=(
+        "The fixture to inspect.\n"
+        "Can be the fixture number or the fixture name.\n"
+        "If not specified, all the fixtures from the specified callback will be inspected,\n"
+        "one JSON object per line."))
+    inspect_cmd.add_argument('-F', '--fields', action='append', help=(
+        "Only output this field, e.g. 'request.url' or 'output_data[*].type'.\n"
+        "Can be given several times."))
+    inspect_cmd.add_argument('-j', '--jobs', type=int, help=(
+        "Number of processes used to read fixtures.\n"
+        "Defaults to the number of CPUs."))
 
     update_cmd = subparsers.add_parser(
         'update',
@@ -246,5 +590,182 @@ def main():
         "Can be the fixture number or the fixture name.\n"
         "If not specified, all the fixtures from the specified callback will be updated."))
 
+    subparsers.add_parser(
+        'serve',
+        description=(
+            "Runs a playback server that keeps the project loaded.\n"
+            "Spider modules changed on disk are reloaded before each run."),
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    play_cmd = subparsers.add_parser(
+        'play',
+        description=(
+            "Plays fixtures back and reports their results.\n"
+            "Fixtures are sent to the running `autounit serve` server if there is one."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    play_cmd.add_argument('-s', '--spider', help=(
+        "The spider to play.\n"
+        "If not specified, all the spiders from the current project will be played."))
+    play_cmd.add_argument('-c', '--callback', help=(
+        "The callback to play.\n"
+        "If not specified, all the callbacks from the specified spider will be played."))
+    play_cmd.add_argument('-f', '--fixture', help=(
+        "The fixture to play.\n"
+        "Can be the fixture number or the fixture name.\n"
+        "If not specified, all the fixtures from the specified callback will be played."))
+    play_cmd.add_argument('--stop', action='store_true', help="Stops the running server.")
+    play_cmd.add_argument('-j', '--jobs', type=int, help=(
+        "Number of processes used to play fixtures.\n"
+        "Defaults to playing them in this process, or in the running server."))
+    play_cmd.add_argument('--budget', help=(
+        "Only play the fixtures that fit in this time, e.g. '90s' or '5m'.\n"
+        "At least one fixture is played for each callback."))
+
+    watch_cmd = subparsers.add_parser(
+        'watch',
+        description=(
+            "Plays the fixtures affected by every change to the project modules.\n"
+            "When only some callbacks of a spider change, just their fixtures are played."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    watch_cmd.add_argument('-i', '--interval', type=float, default=0.5, help=(
+        "Seconds between checks for changed files.\n"
+        "Defaults to 0.5."))
+
+    impact_cmd = subparsers.add_parser(
+        'impact',
+        description=(
+            "Lists the fixtures affected by a change to spider middlewares, settings\n"
+            "or callbacks, one path per line."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    impact_cmd.add_argument('-m', '--middleware', action='append', help=(
+        "The path of a changed spider middleware, or of the module defining it.\n"
+        "Can be given several times."))
+    impact_cmd.add_argument('-S', '--setting', action='append', help=(
+        "The name of a changed setting from AUTOUNIT_RECORD_SETTINGS.\n"
+        "Can be given several times."))
+    impact_cmd.add_argument('-c', '--callback', dest='callbacks', action='append', help=(
+        "The name of a changed callback.\n"
+        "Can be given several times."))
+    impact_cmd.add_argument('-s', '--spider', help=(
+        "Only list fixtures from this spider."))
+    impact_cmd.add_argument('--play', action='store_true', help=(
+        "Play the affected fixtures instead of listing them."))
+
+    merge_cmd = subparsers.add_parser(
+        'merge',
+        description=(
+            "Merges the fixtures recorded with AUTOUNIT_STAGING enabled.\n"
+            "Duplicates are dropped and up to AUTOUNIT_MAX_FIXTURES_PER_CALLBACK\n"
+            "fixtures are kept for each callback."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    merge_cmd.add_argument('-j', '--jobs', type=int, help=(
+        "Number of processes used to read the staged fixtures.\n"
+        "Defaults to the number of CPUs."))
+    merge_cmd.add_argument(
+        '--keep-staging', action='store_true',
+        help="Don't remove the staged recordings after merging them.")
+
+    migrate_cmd = subparsers.add_parser(
+        'migrate',
+        description=(
+            "Converts fixtures recorded by old versions to the current format\n"
+            "without playing them back. Run it again to resume an interrupted migration."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    migrate_cmd.add_argument('-s', '--spider', help=(
+        "The spider to migrate.\n"
+        "If not specified, all the spiders from the current project will be migrated."))
+    migrate_cmd.add_argument('-c', '--callback', help=(
+        "The callback to migrate.\n"
+        "If not specified, all the callbacks from the specified spider will be migrated."))
+    migrate_cmd.add_argument('-j', '--jobs', type=int, help=(
+        "Number of processes used to migrate fixtures.\n"
+        "Defaults to the number of CPUs."))
+
+    gc_cmd = subparsers.add_parser(
+        'gc',
+        description=(
+            "Removes the fixtures of spiders and callbacks that no longer exist,\n"
+            "duplicated fixtures, and oversized ones or the ones over a disk budget."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    gc_cmd.add_argument('-s', '--spider', help=(
+        "The spider to clean up.\n"
+        "If not specified, all the spiders from the current project will be cleaned up."))
+    gc_cmd.add_argument('--max-size', help=(
+        "Remove fixtures bigger than this, e.g. '500k' or '2M'."))
+    gc_cmd.add_argument('--budget', help=(
+        "Remove the biggest fixtures until all of them take up to this, e.g. '1G'.\n"
+        "Every callback keeps at least one fixture."))
+    gc_cmd.add_argument('--spider-budget', help=(
+        "Like --budget, for the fixtures of each spider."))
+    gc_cmd.add_argument('--same-request', action='store_true', help=(
+        "Also remove fixtures recorded for the same request as another one,\n"
+        "even when their data is different."))
+    gc_cmd.add_argument('-n', '--dry-run', action='store_true', help=(
+        "Only list what would be removed."))
+
+    compact_cmd = subparsers.add_parser(
+        'compact',
+        description=(
+            "Removes replaced and deleted fixtures from fixture packs and moves\n"
+            "fixtures to the format set in AUTOUNIT_FIXTURE_FORMAT."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    compact_cmd.add_argument('-s', '--spider', help=(
+        "The spider to compact.\n"
+        "If not specified, all the spiders from the current project will be compacted."))
+    compact_cmd.add_argument('-c', '--callback', help=(
+        "The callback to compact.\n"
+        "If not specified, all the callbacks from the specified spider will be compacted."))
+    compact_cmd.add_argument('--format', choices=FORMATS, help=(
+        "The format to move fixtures to.\n"
+        "Defaults to AUTOUNIT_FIXTURE_FORMAT."))
+
+    query_cmd = subparsers.add_parser(
+        'query',
+        description=(
+            "Prints the metadata of the fixtures stored in the fixtures database\n"
+            "as JSON lines, without loading the fixtures."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    query_cmd.add_argument('-s', '--spider', help=(
+        "The spider to query.\n"
+        "If not specified, fixtures from all the spiders are queried."))
+    query_cmd.add_argument('-c', '--callback', help=(
+        "The callback to query.\n"
+        "If not specified, fixtures from all the callbacks of the specified spider are queried."))
+    query_cmd.add_argument('-w', '--where', help=(
+        "An SQL condition on the fixtures metadata, e.g.\n"
+        "\"status != 200 AND size > 1000000\".\n"
+        "Columns: spider, callback, fingerprint, method, url, status,\n"
+        "response_class, body_size, items, requests, size."))
+
+    convert_cmd = subparsers.add_parser(
+        'convert',
+        description="Converts fixtures between the pickle and JSON serializations.",
+        formatter_class=argparse.RawTextHelpFormatter)
+    convert_cmd.add_argument('-s', '--spider', help=(
+        "The spider to convert.\n"
+        "If not specified, all the spiders from the current project will be converted."))
+    convert_cmd.add_argument('-c', '--callback', help=(
+        "The callback to convert.\n"
+        "If not specified, all the callbacks from the specified spider will be converted."))
+    convert_cmd.add_argument('-f', '--fixture', help=(
+        "The fixture to convert.\n"
+        "Can be the fixture number or the fixture name.\n"
+        "If not specified, all the fixtures from the specified callback will be converted."))
+    convert_cmd.add_argument('--to', choices=('pickle', 'json'), help=(
+        "The serialization to convert fixtures to.\n"
+        "Defaults to AUTOUNIT_SERIALIZATION."))
+
+    diff_cmd = subparsers.add_parser(
+        'diff',
+        description=(
+            "Compares the outputs and spider attributes of two recordings.\n"
+            "Fixtures are paired by spider, callback and request fingerprint."),
+        formatter_class=argparse.RawTextHelpFormatter)
+    diff_cmd.add_argument('dir_a', help="The autounit directory of the first recording.")
+    diff_cmd.add_argument('dir_b', help="The autounit directory of the second recording.")
+    diff_cmd.add_argument('-j', '--jobs', type=int, help=(
+        "Number of processes used to compare fixtures.\n"
+        "Defaults to the number of CPUs."))
+
     cli = CommandLine(parser)
     cli.parse_command()
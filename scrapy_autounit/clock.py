@@ -0,0 +1,165 @@
+import datetime
+import os
+import random
+import sys
+import time
+
+from .utils import get_project_dir
+
+
+_real_time = time.time
+_real_time_ns = getattr(time, 'time_ns', None)
+_real_datetime = datetime.datetime
+_real_date = datetime.date
+
+# Only one clock can be running at a time
+_running = None
+
+
+class _FakeMeta(type):
+    # Real dates and datetimes are still instances of the patched classes
+    def __instancecheck__(cls, obj):
+        return isinstance(obj, cls._real)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, cls._real)
+
+
+def _now(cls, tz=None):
+    return _real_datetime.fromtimestamp(time.time(), tz)
+
+
+def _utcnow(cls):
+    return _real_datetime.utcfromtimestamp(time.time())
+
+
+def _today(cls):
+    return _real_date.fromtimestamp(time.time())
+
+
+FakeDatetime = _FakeMeta('FakeDatetime', (_real_datetime,), {
+    '_real': _real_datetime,
+    'now': classmethod(_now),
+    'utcnow': classmethod(_utcnow),
+    'today': classmethod(_now),
+})
+FakeDate = _FakeMeta('FakeDate', (_real_date,), {
+    '_real': _real_date,
+    'today': classmethod(_today),
+})
+
+
+_project_dir = []
+
+
+def _project_modules(spider_cls=None):
+    if not _project_dir:
+        _project_dir.append(get_project_dir())
+    modules = {}
+    if _project_dir[0]:
+        project_dir = os.path.join(_project_dir[0], '')
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if path and path.startswith(project_dir) and 'site-packages' not in path:
+                modules[name] = module
+    # Spiders are patched even when the project directory isn't found
+    for cls in getattr(spider_cls, '__mro__', ()):
+        if cls.__module__ in sys.modules:
+            modules.setdefault(cls.__module__, sys.modules[cls.__module__])
+    return modules.values()
+
+
+class Clock:
+    """
+    Freezes the time and seeds the random module while a callback runs.
+
+    `time.time`, `datetime.datetime.now`, `utcnow`, `today` and
+    `datetime.date.today` return `frozen_time`, also when the project
+    modules or the modules of `spider_cls` imported them by name, and
+    `random` is seeded with `seed`. Either can be None to leave it alone.
+    """
+    def __init__(self, frozen_time=None, seed=None, spider_cls=None):
+        self.frozen_time = frozen_time
+        self.seed = seed
+        self.spider_cls = spider_cls
+        self.patched = []
+        self.random_state = None
+        self.seeded_state = None
+
+    @classmethod
+    def new(cls, freeze_time=False, seed_random=False, spider_cls=None):
+        """
+        Return a clock frozen at the current time and seeded with a new
+        random seed.
+        """
+        return cls(
+            frozen_time=_real_time() if freeze_time else None,
+            seed=random.SystemRandom().randrange(2 ** 32) if seed_random else None,
+            spider_cls=spider_cls,
+        )
+
+    def to_dict(self):
+        return {'time': self.frozen_time, 'seed': self.seed}
+
+    @classmethod
+    def from_dict(cls, data, spider_cls=None):
+        return cls(frozen_time=data.get('time'), seed=data.get('seed'), spider_cls=spider_cls)
+
+    def _patch(self, namespace, name, value):
+        self.patched.append((namespace, name, getattr(namespace, name)))
+        setattr(namespace, name, value)
+
+    def _patch_time(self):
+        frozen_time = self.frozen_time
+        replacements = {
+            _real_time: lambda: frozen_time,
+            _real_datetime: FakeDatetime,
+            _real_date: FakeDate,
+        }
+        if _real_time_ns is not None:
+            replacements[_real_time_ns] = lambda: int(frozen_time * 1e9)
+        self._patch(time, 'time', replacements[_real_time])
+        if _real_time_ns is not None:
+            self._patch(time, 'time_ns', replacements[_real_time_ns])
+        self._patch(datetime, 'datetime', FakeDatetime)
+        self._patch(datetime, 'date', FakeDate)
+        # Names imported with `from time import time` and the like
+        for module in _project_modules(self.spider_cls):
+            for name, value in list(vars(module).items()):
+                try:
+                    replacement = replacements.get(value)
+                except Exception:
+                    continue
+                if replacement is not None:
+                    self._patch(module, name, replacement)
+
+    def start(self):
+        """
+        Start the clock, unless another one is running. A stopped clock
+        can be started again and random carries on where it was left.
+        """
+        global _running
+        if _running is not None:
+            return
+        if self.frozen_time is not None:
+            self._patch_time()
+        if self.seed is not None:
+            self.random_state = random.getstate()
+            if self.seeded_state is None:
+                random.seed(self.seed)
+            else:
+                random.setstate(self.seeded_state)
+        _running = self
+
+    def stop(self):
+        global _running
+        if _running is not self:
+            return
+        for namespace, name, value in reversed(self.patched):
+            setattr(namespace, name, value)
+        self.patched = []
+        if self.seed is not None:
+            self.seeded_state = random.getstate()
+            random.setstate(self.random_state)
+            self.random_state = None
+        _running = None
@@ -0,0 +1,125 @@
+import os
+from multiprocessing import Pool, cpu_count
+
+from .cassette import Cassette
+from .manifest import Manifest
+from .merge import get_fixture_info
+from .storage import list_fixtures
+from .utils import parse_data
+
+
+SECTIONS = ('output_data', 'input_attrs', 'output_attrs')
+
+
+def diff_data(a, b, path=''):
+    """
+    Yield the (change, path, old, new) differences between two values.
+    """
+    if hasattr(a, 'keys') and hasattr(b, 'keys'):
+        for key in sorted(set(a.keys()) | set(b.keys()), key=repr):
+            sub_path = '{}.{}'.format(path, key) if path else str(key)
+            if key not in a:
+                yield 'added', sub_path, None, b[key]
+            elif key not in b:
+                yield 'removed', sub_path, a[key], None
+            else:
+                for change in diff_data(a[key], b[key], sub_path):
+                    yield change
+    elif isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        for index in range(max(len(a), len(b))):
+            sub_path = '{}[{}]'.format(path, index)
+            if index >= len(a):
+                yield 'added', sub_path, None, b[index]
+            elif index >= len(b):
+                yield 'removed', sub_path, a[index], None
+            else:
+                for change in diff_data(a[index], b[index], sub_path):
+                    yield change
+    elif type(a) is not type(b) or a != b:
+        yield 'changed', path, a, b
+
+
+def _fixture_order(info):
+    # fixture2.bin comes before fixture10.bin
+    path = info[0]
+    name = os.path.basename(path)
+    return os.path.dirname(path), len(name), name
+
+
+def _diff_fixtures(paths):
+    path_a, path_b = paths
+    a, b = Cassette.from_fixture(path_a), Cassette.from_fixture(path_b)
+    changes = []
+    for section in SECTIONS:
+        for change, path, old, new in diff_data(getattr(a, section), getattr(b, section), section):
+            changes.append((change, path, parse_data(old), parse_data(new)))
+    return path_a, path_b, changes
+
+
+class Differ:
+    """
+    Compares two recordings of the same spiders, pairing their fixtures
+    by request fingerprint, and by name when several fixtures have the
+    same fingerprint.
+    """
+    def __init__(self, base_a, base_b, jobs=None):
+        self.bases = (base_a, base_b)
+        self.jobs = jobs or cpu_count()
+
+    def _iter_fixtures(self, base_path):
+        manifest = Manifest(base_path)
+        for root, _, _ in os.walk(os.path.join(base_path, 'tests')):
+            for path in list_fixtures(root):
+                yield path, manifest.fixtures.get(manifest.get_key(path))
+
+    def _map(self, pool, func, tasks):
+        if pool is None:
+            return [func(task) for task in tasks]
+        return pool.map(func, tasks, chunksize=8)
+
+    def _index(self, base_path, infos):
+        fixtures = {}
+        occurrences = {}
+        for path, digest, entry in sorted(infos, key=_fixture_order):
+            # Fixtures recorded before fingerprints were stored are paired
+            # by their path instead
+            request = entry.get('fingerprint') or os.path.relpath(path, base_path)
+            key = (entry['spider'], entry['callback'], request)
+            # Fixtures of the same request are paired in the order of
+            # their names
+            occurrences[key] = occurrences.get(key, 0) + 1
+            fixtures[key + (occurrences[key],)] = (path, digest)
+        return fixtures
+
+    def diff(self):
+        tasks = [list(self._iter_fixtures(base)) for base in self.bases]
+        pool = Pool(self.jobs) if self.jobs > 1 and sum(map(len, tasks)) > 1 else None
+        try:
+            fixtures_a, fixtures_b = [
+                self._index(base, self._map(pool, get_fixture_info, base_tasks))
+                for base, base_tasks in zip(self.bases, tasks)
+            ]
+            result = {
+                'only_a': sorted(fixtures_a[k][0] for k in set(fixtures_a) - set(fixtures_b)),
+                'only_b': sorted(fixtures_b[k][0] for k in set(fixtures_b) - set(fixtures_a)),
+                'identical': 0,
+                'same_output': 0,
+                'changed': [],
+            }
+            to_compare = []
+            for key in sorted(set(fixtures_a) & set(fixtures_b)):
+                (path_a, digest_a), (path_b, digest_b) = fixtures_a[key], fixtures_b[key]
+                if digest_a == digest_b:
+                    result['identical'] += 1
+                else:
+                    to_compare.append((path_a, path_b))
+            for path_a, path_b, changes in self._map(pool, _diff_fixtures, to_compare):
+                if changes:
+                    result['changed'].append((path_a, path_b, changes))
+                else:
+                    result['same_output'] += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return result
@@ -0,0 +1,118 @@
+import json
+import os
+
+
+class Manifest:
+    """
+    Index of the recorded fixtures, stored as JSON in the autounit base path.
+    """
+    FILENAME = 'manifest.json'
+    VERSION = 1
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.path = os.path.join(base_path, self.FILENAME)
+        data = self._load_data()
+        self.fixtures = data.get('fixtures', {})
+        # Fixtures kept per callback by the spiders recorded into staging
+        # directories, used when merging them
+        self.max_fixtures = data.get('max_fixtures', {})
+        self._added = {}
+        self._discarded = []
+
+    def _load_data(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _load(self):
+        return self._load_data().get('fixtures', {})
+
+    def get_key(self, path):
+        return os.path.relpath(path, self.base_path).replace(os.sep, '/')
+
+    def _discard(self, fixtures, prefix):
+        for key in list(fixtures):
+            if key.startswith(prefix):
+                del fixtures[key]
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def get_path(self, key):
+        return os.path.join(self.base_path, *key.split('/'))
+
+    @staticmethod
+    def get_entry(cassette):
+        return {
+            'spider': cassette.spider_name,
+            'callback': cassette.request['callback'],
+            'fingerprint': cassette.fingerprint,
+            'middlewares': list(cassette.middlewares or []),
+            'settings': sorted(cassette.included_settings or {}),
+        }
+
+    def add(self, path, cassette):
+        self.add_entry(path, self.get_entry(cassette))
+
+    def add_entry(self, path, entry):
+        key = self.get_key(path)
+        self.fixtures[key] = entry
+        self._added[key] = entry
+
+    def find(self, middlewares=(), settings=(), callbacks=(), keys=None):
+        """
+        Return the keys of the fixtures that ran any of the given spider
+        middlewares or modules of middlewares, were recorded with any of
+        the given settings, or belong to any of the given callbacks.
+        """
+        index = {'middleware': {}, 'setting': {}, 'callback': {}}
+        for key in (self.fixtures if keys is None else keys):
+            entry = self.fixtures[key]
+            for middleware in entry.get('middlewares', []):
+                index['middleware'].setdefault(middleware, set()).add(key)
+            for name in entry.get('settings', []):
+                index['setting'].setdefault(name, set()).add(key)
+            index['callback'].setdefault(entry['callback'], set()).add(key)
+
+        found = set()
+        for middleware in middlewares:
+            for path, path_keys in index['middleware'].items():
+                if path == middleware or path.startswith(middleware + '.'):
+                    found.update(path_keys)
+        for name in settings:
+            found.update(index['setting'].get(name, ()))
+        for callback in callbacks:
+            found.update(index['callback'].get(callback, ()))
+        return found
+
+    def discard(self, path):
+        prefix = self.get_key(path) + '/'
+        self._discarded.append(prefix)
+        self._discard(self.fixtures, prefix)
+        for key in list(self._added):
+            if key.startswith(prefix):
+                del self._added[key]
+
+    def remove(self, path):
+        key = self.get_key(path)
+        self._discarded.append(key)
+        self.fixtures.pop(key, None)
+        self._added.pop(key, None)
+
+    def save(self):
+        # Reload the manifest before writing it so changes made by
+        # other processes to unrelated spiders are not lost
+        data = self._load_data()
+        fixtures = data.get('fixtures', {})
+        for prefix in self._discarded:
+            self._discard(fixtures, prefix)
+        fixtures.update(self._added)
+        self.fixtures = fixtures
+        max_fixtures = dict(data.get('max_fixtures', {}), **self.max_fixtures)
+        data = {'version': self.VERSION, 'fixtures': fixtures}
+        if max_fixtures:
+            data['max_fixtures'] = max_fixtures
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import re
+import shutil
+from multiprocessing import Pool, cpu_count
+
+from .cassette import Cassette
+from .manifest import Manifest
+from .recorder import TEST_TEMPLATE, get_max_fixtures
+from .sampling import get_sampling_key
+from .storage import (
+    clear_fixtures, close_database, get_format, list_fixtures, open_database, read_fixture,
+    write_fixture,
+)
+from .utils import get_spider_class, get_staging_dir
+
+
+def get_fixture_info(args):
+    path, entry = args
+    # Fixtures don't include their filename, so identical
+    # cassettes give identical data
+    digest = hashlib.sha1(read_fixture(path)).hexdigest()
+    if entry is None:
+        entry = Manifest.get_entry(Cassette.from_fixture(path))
+    return path, digest, entry
+
+
+class Merger:
+    """
+    Combines the fixtures recorded by several processes with
+    AUTOUNIT_STAGING enabled into the final fixtures layout.
+    """
+    def __init__(self, settings, base_path, jobs=None):
+        self.settings = settings
+        self.base_path = base_path
+        self.tests_dir = os.path.join(base_path, 'tests')
+        self.staging_dir = get_staging_dir(base_path)
+        self.seed = settings.get('AUTOUNIT_SAMPLING_SEED')
+        self.jobs = jobs or cpu_count()
+        self.max_fixtures = {}
+        self.staged_max_fixtures = {}
+        self.fixture_format = get_format(settings)
+
+    def get_staged(self):
+        if not os.path.isdir(self.staging_dir):
+            return []
+        return sorted(
+            os.path.join(self.staging_dir, name)
+            for name in os.listdir(self.staging_dir)
+            if os.path.isdir(os.path.join(self.staging_dir, name))
+        )
+
+    def _iter_fixtures(self, staged):
+        for staging in staged:
+            manifest = Manifest(staging)
+            for spider_name, max_fixtures in manifest.max_fixtures.items():
+                self.staged_max_fixtures[spider_name] = max(
+                    max_fixtures, self.staged_max_fixtures.get(spider_name, 0))
+            tests_dir = os.path.join(staging, 'tests')
+            for root, _, _ in os.walk(tests_dir):
+                for path in list_fixtures(root):
+                    yield path, manifest.fixtures.get(manifest.get_key(path))
+
+    def _get_max_fixtures(self, spider_name):
+        # The limit the recording processes used, which may come from
+        # settings given to the crawl only
+        if spider_name in self.staged_max_fixtures:
+            return self.staged_max_fixtures[spider_name]
+        # Spiders may raise the limit in their custom settings
+        if spider_name not in self.max_fixtures:
+            settings = self.settings.copy()
+            spider_cls = get_spider_class(spider_name, self.settings)
+            if spider_cls is not None:
+                spider_cls.update_settings(settings)
+            self.max_fixtures[spider_name] = get_max_fixtures(settings)
+        return self.max_fixtures[spider_name]
+
+    def _load(self, staged):
+        tasks = list(self._iter_fixtures(staged))
+        if self.jobs == 1 or len(tasks) < 2:
+            return [get_fixture_info(task) for task in tasks]
+        pool = Pool(self.jobs)
+        try:
+            return pool.map(get_fixture_info, tasks, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _sampling_key(self, fixture):
+        _, digest, entry = fixture
+        # Same keys as the recorder uses with a sampling seed, so fixtures
+        # kept in every process are also kept after merging
+        return get_sampling_key(entry.get('fingerprint') or digest, self.seed), digest
+
+    def _select(self, fixtures, max_fixtures):
+        selected, seen = [], set()
+        for fixture in sorted(fixtures, key=self._sampling_key):
+            _, digest, entry = fixture
+            # The same request may have been recorded by several processes
+            fingerprint = entry.get('fingerprint') if self.seed is not None else None
+            if digest in seen or fingerprint in seen:
+                continue
+            seen.update(x for x in (digest, fingerprint) if x)
+            selected.append(fixture)
+            if len(selected) == max_fixtures:
+                break
+        return selected
+
+    def _get_test_dir(self, parts):
+        test_dir = None
+        for comp in [self.base_path, 'tests'] + list(parts):
+            test_dir = os.path.join(test_dir, comp) if test_dir else comp
+            if not os.path.isdir(test_dir):
+                os.makedirs(test_dir)
+            init_file = os.path.join(test_dir, '__init__.py')
+            with open(init_file, 'a'):
+                os.utime(init_file, None)
+        return test_dir
+
+    def _write(self, manifest, parts, fixtures):
+        test_dir = self._get_test_dir(parts)
+        for index, (path, _, entry) in enumerate(fixtures, 1):
+            # Only the index is renumbered, names may also have the value
+            # of AUTOUNIT_FIXTURE_NAMING_ATTR
+            match = re.match(r'^(.*?)\d+\.bin$', os.path.basename(path))
+            stem = match.group(1) if match else 'fixture'
+            dest = os.path.join(test_dir, '{}{}.bin'.format(stem, index))
+            write_fixture(dest, read_fixture(path), self.fixture_format)
+            manifest.add_entry(dest, entry)
+        test_name = parts[0] + '__' + parts[-1]
+        test_code = TEST_TEMPLATE.format(test_name=test_name, command='autounit merge')
+        with open(os.path.join(test_dir, 'test_fixtures.py'), 'w') as f:
+            f.write(test_code)
+
+    def merge(self, keep_staging=False):
+        staged = self.get_staged()
+        groups = {}
+        for fixture in self._load(staged):
+            path = fixture[0]
+            rel = os.path.relpath(os.path.dirname(path), self.staging_dir)
+            # <staging name>/tests/<spider>[/<extra path>]/<callback>
+            parts = tuple(rel.split(os.sep)[2:])
+            groups.setdefault(parts, []).append(fixture)
+
+        manifest = Manifest(self.base_path)
+        if self.fixture_format == 'sqlite':
+            open_database(self.base_path)
+        # Recording a spider replaces all its fixtures
+        for spider in set(parts[0] for parts in groups):
+            spider_dir = os.path.join(self.tests_dir, spider)
+            clear_fixtures(spider_dir)
+            manifest.discard(spider_dir)
+
+        stats = {'processes': len(staged), 'recorded': 0, 'kept': 0}
+        for parts in sorted(groups):
+            fixtures = groups[parts]
+            max_fixtures = self._get_max_fixtures(fixtures[0][2]['spider'])
+            selected = self._select(fixtures, max_fixtures)
+            self._write(manifest, parts, selected)
+            stats['recorded'] += len(fixtures)
+            stats['kept'] += len(selected)
+        manifest.save()
+
+        if not keep_staging:
+            for staging in staged:
+                close_database(staging)
+                shutil.rmtree(staging)
+            if os.path.isdir(self.staging_dir) and not os.listdir(self.staging_dir):
+                os.rmdir(self.staging_dir)
+        return stats
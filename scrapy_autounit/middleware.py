@@ -1,11 +1,12 @@
 import logging
+import os
 import pickle
+import random
+import tempfile
 
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
 
-from .recorder import Recorder
-
 
 logger = logging.getLogger(__name__)
 
@@ -22,29 +23,116 @@ class AutounitMiddleware:
         if not settings.getbool('AUTOUNIT_ENABLED'):
             raise NotConfigured('scrapy-autounit is not enabled')
 
-        if settings.getint('CONCURRENT_REQUESTS') > 1:
-            logger.warning(
-                'Recording with concurrency > 1! '
-                'Data races in shared object modification may create broken tests.'
-            )
+        spider_name = crawler.spidercls.name
+        record_spiders = settings.getlist('AUTOUNIT_RECORD_SPIDERS')
+        if record_spiders and spider_name not in record_spiders:
+            raise NotConfigured('scrapy-autounit is not enabled for this spider')
+        if spider_name in settings.getlist('AUTOUNIT_DONT_RECORD_SPIDERS'):
+            raise NotConfigured('scrapy-autounit is not enabled for this spider')
+
+        self.record_callbacks = set(settings.getlist('AUTOUNIT_RECORD_CALLBACKS'))
+        self.dont_record_callbacks = set(settings.getlist('AUTOUNIT_DONT_RECORD_CALLBACKS'))
+        self.sampling_rate = settings.getfloat('AUTOUNIT_SAMPLING_RATE', 1.0)
+        self.sampling_seed = settings.get('AUTOUNIT_SAMPLING_SEED')
+        self.filter_callbacks = bool(self.record_callbacks or self.dont_record_callbacks)
+
+        self.max_body_size = settings.getint('AUTOUNIT_MAX_BODY_SIZE', 0)
+        self.memory_budget = settings.getint('AUTOUNIT_MEMORY_BUDGET', 0)
+        self.in_flight = 0
 
     @classmethod
     def from_crawler(cls, crawler):
         mw = cls(crawler)
         crawler.signals.connect(mw.engine_started, signal=signals.engine_started)
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
         return mw
 
     def engine_started(self):
+        # Imported here so that having the middleware listed in the settings
+        # doesn't load the recording machinery when autounit is disabled
+        from .recorder import Recorder
+
         self.recorder = Recorder(self.crawler.spider)
         for warning in self.recorder.deprecated_settings():
             logger.warn(warning)
 
+    def spider_closed(self):
+        self.recorder.close()
+
+    def _sampled(self, request):
+        if self.sampling_seed is None:
+            return random.random() < self.sampling_rate
+        from .sampling import get_sampling_key
+        from .utils import get_fingerprint
+
+        fingerprint = get_fingerprint(request, self.crawler)
+        return get_sampling_key(fingerprint, self.sampling_seed) < self.sampling_rate
+
+    def _should_record(self, response, spider):
+        if self.sampling_rate < 1 and not self._sampled(response.request):
+            return False
+        if not self.filter_callbacks:
+            return True
+        from .parser import get_callback_name
+
+        callback = get_callback_name(response.request, spider)
+        if self.record_callbacks and callback not in self.record_callbacks:
+            return False
+        return callback not in self.dont_record_callbacks
+
+    def _store_cassette(self, response, cassette):
+        # The body is left out and taken back from the response when the
+        # cassette is loaded, so it isn't copied while the callback runs
+        cassette.response['body'] = b''
+        data = pickle.dumps(cassette, protocol=2)
+        stats = self.crawler.stats
+        # Cassettes that don't fit in the in-flight memory budget wait
+        # for the callback output in a temporary file instead
+        if self.memory_budget and self.in_flight + len(data) > self.memory_budget:
+            fd, path = tempfile.mkstemp(prefix='autounit-', suffix='.cassette')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            response.meta['_autounit_cassette_file'] = path
+            stats.inc_value('autounit/cassettes/spilled')
+            return
+        self.in_flight += len(data)
+        stats.max_value('autounit/cassettes/max_in_flight_bytes', self.in_flight)
+        response.meta['_autounit_cassette'] = data
+
+    def _load_cassette(self, response):
+        data = response.meta.pop('_autounit_cassette', None)
+        if data is not None:
+            self.in_flight -= len(data)
+        else:
+            path = response.meta.pop('_autounit_cassette_file', None)
+            if path is None:
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.remove(path)
+        cassette = pickle.loads(data)
+        cassette.response['body'] = response.body
+        return cassette
+
     def process_spider_input(self, response, spider):
+        if not self._should_record(response, spider):
+            return None
+        if self.max_body_size and len(response.body) > self.max_body_size:
+            self.crawler.stats.inc_value('autounit/skipped/body_size')
+            return None
         cassette = self.recorder.new_cassette(response)
-        response.meta['_autounit_cassette'] = pickle.dumps(cassette, protocol=2)
+        self._store_cassette(response, cassette)
         return None
 
     def process_spider_output(self, response, result, spider):
-        cassette = pickle.loads(response.meta.pop('_autounit_cassette'))
-        out = self.recorder.record(cassette, result)
+        cassette = self._load_cassette(response)
+        if cassette is None:
+            return result
+        out = self.recorder.record(cassette, result, response)
         return out
+
+    def process_spider_exception(self, response, exception, spider):
+        # Release the cassette of a callback that failed
+        if self._load_cassette(response) is not None:
+            self.recorder.discard(response)
+        return None
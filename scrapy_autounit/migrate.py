@@ -0,0 +1,162 @@
+import copy
+import os
+import pickle
+import re
+import sys
+from glob import glob
+from multiprocessing import Pool, cpu_count
+
+from scrapy.commands.genspider import sanitize_module_name
+
+from .cassette import Cassette
+from .storage import list_fixtures, read_fixture, write_fixture
+
+
+def from_legacy_fixture(recorded):
+    encoding = recorded.get('encoding', 'utf-8')
+    data = recorded.get('data')
+    old = recorded if not data else pickle.loads(data, encoding=encoding)
+    return Cassette(
+        spider_name=old['spider_name'],
+        request=old['request'],
+        response=old['response'],
+        init_attrs={},
+        input_attrs=old.get('spider_args_in') or old.get('spider_args') or {},
+        output_attrs=old.get('spider_args_out', {}),
+        output_data=old['result'],
+        middlewares=old['middlewares'],
+        included_settings=old['settings'],
+        python_version=old.get('python_version', sys.version_info.major),
+    )
+
+
+def update_legacy_test(path, cassette):
+    from .recorder import TEST_TEMPLATE
+
+    path_dir = os.path.dirname(path)
+    older_version_test = os.path.join(path_dir, 'test_fixture1.py')
+    if os.path.isfile(older_version_test):
+        to_remove = os.path.join(path_dir, 'test_fixture*.py')
+        for test in glob(to_remove):
+            if test == older_version_test:
+                os.rename(test, path)
+                continue
+            os.remove(test)
+    test_name = (
+        sanitize_module_name(cassette.spider_name) + '__' +
+        cassette.request['callback']
+    )
+    with open(path, 'r+') as f:
+        old = f.read()
+        command = 'Scrapy Autounit'
+        command_re = re.search('# Generated by: (.*)  # noqa', old)
+        if command_re:
+            command = command_re.group(1)
+        test_code = TEST_TEMPLATE.format(test_name=test_name, command=command)
+        f.seek(0)
+        f.write(test_code)
+        f.truncate()
+
+
+# Attributes set by each spider's init, worked out once per process
+_init_attrs = {}
+
+
+def get_init_attrs(cassette):
+    # Legacy fixtures don't have them, they are taken from the spider
+    # without running any callback
+    from .player import Player
+
+    if cassette.spider_name not in _init_attrs:
+        try:
+            player = Player(cassette)
+            player._init_spider()
+            _init_attrs[cassette.spider_name] = player.spider_attrs()
+        except Exception:
+            # Left empty, `autounit update` sets them once the spider loads
+            _init_attrs[cassette.spider_name] = {}
+    return copy.deepcopy(_init_attrs[cassette.spider_name])
+
+
+def migrate_callback(task):
+    callback_dir, paths, serialization = task
+    results = []
+    cassette = None
+    for path in paths:
+        try:
+            recorded = Cassette.unpack(read_fixture(path))
+            if not isinstance(recorded, dict):
+                results.append((path, 'current', None))
+                continue
+            cassette = from_legacy_fixture(recorded)
+            cassette.init_attrs = get_init_attrs(cassette)
+            write_fixture(path, cassette.pack_chunks(serialization), cassette=cassette)
+            results.append((path, 'migrated', None))
+        except Exception as e:
+            results.append((path, 'error', '{}: {}'.format(type(e).__name__, e)))
+    if cassette is not None:
+        test_path = os.path.join(callback_dir, 'test_fixtures.py')
+        if os.path.isfile(test_path) or glob(os.path.join(callback_dir, 'test_fixture*.py')):
+            update_legacy_test(test_path, cassette)
+    return results
+
+
+class Migrator:
+    """
+    Converts legacy fixtures to cassettes without playing them back.
+
+    Callback directories are converted by several processes and the
+    fixtures done are appended to a journal, so an interrupted migration
+    carries on where it stopped when run again.
+    """
+    JOURNAL_FILENAME = 'migrate.journal'
+
+    def __init__(self, base_path, serialization='pickle', jobs=None):
+        self.base_path = base_path
+        self.serialization = serialization
+        self.jobs = jobs or cpu_count()
+        self.journal_path = os.path.join(base_path, self.JOURNAL_FILENAME)
+
+    def _get_key(self, path):
+        return os.path.relpath(path, self.base_path).replace(os.sep, '/')
+
+    def _load_journal(self):
+        if not os.path.isfile(self.journal_path):
+            return set()
+        with open(self.journal_path) as f:
+            return set(line.rstrip('\n') for line in f)
+
+    def migrate(self, callback_dirs):
+        """
+        Yield the (path, status, error) result of each fixture, where
+        status is one of 'migrated', 'current' or 'error'.
+        """
+        done = self._load_journal()
+        tasks = []
+        for callback_dir in callback_dirs:
+            paths = [p for p in list_fixtures(callback_dir) if self._get_key(p) not in done]
+            if paths:
+                tasks.append((callback_dir, paths, self.serialization))
+
+        pool = Pool(self.jobs) if self.jobs > 1 and len(tasks) > 1 else None
+        results = (
+            map(migrate_callback, tasks) if pool is None
+            else pool.imap_unordered(migrate_callback, tasks)
+        )
+        failed = False
+        try:
+            with open(self.journal_path, 'a') as journal:
+                for callback_results in results:
+                    for path, status, error in callback_results:
+                        if status == 'error':
+                            failed = True
+                        else:
+                            journal.write(self._get_key(path) + '\n')
+                        yield path, status, error
+                    journal.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if not failed:
+            os.remove(self.journal_path)
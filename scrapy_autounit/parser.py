@@ -6,6 +6,43 @@ from scrapy.spiders import CrawlSpider
 from scrapy.utils.reqser import request_to_dict
 
 
+def get_callback_name(request, spider):
+    """
+    The name of the spider method that handles `request`, which its
+    fixtures are stored under.
+    """
+    callback = request.callback
+    if callback is None:
+        return 'parse'
+    if isinstance(spider, CrawlSpider):
+        rule = request.meta.get('rule')
+        # Rules without a callback only follow links, their requests keep
+        # the CrawlSpider method as callback
+        if rule is not None and spider.rules[rule].callback:
+            callback = spider.rules[rule].callback
+    return getattr(callback, '__name__', callback)
+
+
+def get_follow_callback(spider):
+    # Requests for the links followed by rules call CrawlSpider._callback,
+    # or _response_downloaded with older Scrapy versions
+    return getattr(spider, '_callback', None) or getattr(spider, '_response_downloaded', None)
+
+
+def supports_rules(spider):
+    """
+    Whether the rules of `spider` can be recorded and played back, which
+    relies on CrawlSpider internals that aren't part of the Scrapy API.
+    """
+    return (
+        isinstance(spider, CrawlSpider) and
+        isinstance(getattr(spider, '_rules', None), list) and
+        callable(getattr(spider, '_parse_response', None)) and
+        callable(getattr(spider, '_requests_to_follow', None)) and
+        get_follow_callback(spider) is not None
+    )
+
+
 class Parser:
     def _clean_headers(self, headers):
         # Use the new setting, if empty, try the deprecated one
@@ -47,7 +84,7 @@ class Parser:
     def _parse_meta(self, request):
         meta = {}
         for key, value in request.get('meta').items():
-            if key != '_autounit_cassette':
+            if not key.startswith('_autounit_cassette'):
                 meta[key] = self.parse_object(value)
         dont_record = self.spider.settings.get('AUTOUNIT_DONT_RECORD_META', [])
         for path in dont_record:
@@ -56,12 +93,7 @@ class Parser:
 
     def _request_to_dict(self, request):
         _request = request_to_dict(request, spider=self.spider)
-        if not _request['callback']:
-            _request['callback'] = 'parse'
-        elif isinstance(self.spider, CrawlSpider):
-            rule = request.meta.get('rule')
-            if rule is not None:
-                _request['callback'] = self.spider.rules[rule].callback
+        _request['callback'] = get_callback_name(request, self.spider)
         self._clean_headers(_request['headers'])
         _request['meta'] = self._parse_meta(_request)
         return _request
@@ -81,6 +113,31 @@ class Parser:
             'encoding': response.encoding,
         }
 
+    def get_rule(self, request):
+        # Rule responses are recorded like other callbacks otherwise
+        if not supports_rules(self.spider):
+            return None
+        index = request.meta.get('rule')
+        if index is None:
+            return None
+        rule = self.spider._rules[index]
+        return {
+            'index': index,
+            'follow': bool(rule.follow and getattr(self.spider, '_follow_links', True)),
+            'links': 0,
+        }
+
+    def count_followed(self, output):
+        # Requests for the links followed by a CrawlSpider rule come
+        # after the output of the rule callback
+        callback = get_follow_callback(self.spider)
+        count = 0
+        for elem in reversed(output):
+            if not isinstance(elem, Request) or elem.callback != callback:
+                break
+            count += 1
+        return count
+
     def spider_attrs(self):
         to_filter = {'crawler', 'settings', 'start_urls'}
 
@@ -116,11 +173,17 @@ class Parser:
             _object = tuple([self.parse_object(o) for o in _object])
         return _object
 
-    def parse_callback_output(self, output):
+    def parse_callback_output(self, output, limit=0):
         parsed = []
         original = []
         for elem in output:
             original.append(elem)
+            if parsed is None:
+                continue
+            if limit and len(parsed) >= limit:
+                # Too much output to record, stop keeping parsed copies
+                parsed = None
+                continue
             is_request = isinstance(elem, Request)
             if is_request:
                 data = self._request_to_dict(elem)
@@ -1,19 +1,31 @@
 from importlib import import_module
+import copy
 import sys
+import weakref
 
+import scrapy
 from scrapy import signals, Item
 from scrapy.exceptions import NotConfigured
+from scrapy.http import TextResponse
+from scrapy.spiders import CrawlSpider
 from scrapy.utils.misc import load_object, arg_to_iter
 from scrapy.utils.reqser import request_from_dict
-from testfixtures import compare
 
+from .cache import CachedLinkExtractor, get_link_cache, get_selector_cache
 from .cassette import Cassette
-from .parser import Parser
+from .clock import Clock
+from .parser import Parser, supports_rules
+
+
+# Responses built for each cassette, reused when playing it back again
+_responses = weakref.WeakKeyDictionary()
 
 
 class Player(Parser):
-    def __init__(self, cassette):
+    def __init__(self, cassette, spider_cls=None, settings=None):
         self.cassette = cassette
+        self.spider_cls = spider_cls
+        self.settings = settings
 
     @classmethod
     def from_fixture(cls, path):
@@ -46,25 +58,63 @@ class Player(Parser):
                 obj.pop(field, None)
 
     def _check_python_version(self):
+        # JSON fixtures don't depend on the Python version
+        if self.cassette.serialization == 'json':
+            return
         current = sys.version_info.major
         recorded = self.cassette.python_version
         assert current == recorded, (
             'Trying to test python {} fixture while running python {}'.format(recorded, current)
         )
 
+    def _check_rules_support(self):
+        if self.cassette.rule is None or not isinstance(self.spider, CrawlSpider):
+            return
+        assert supports_rules(self.spider), (
+            "Can't play back CrawlSpider rule fixtures with Scrapy {}, the CrawlSpider "
+            "internals they rely on are missing ({})".format(
+                scrapy.__version__, self.cassette.filename)
+        )
+
     def _init_spider(self):
-        spider = self.cassette.get_spider()
+        spider = self.cassette.get_spider(spider_cls=self.spider_cls, settings=self.settings)
         spider.start_requests()
         spider.crawler.signals.send_catch_log(signal=signals.spider_opened, spider=spider)
         self.spider = spider
         self.crawler = spider.crawler
+        if supports_rules(spider):
+            self._cache_links()
+
+    def _cache_links(self):
+        cache = get_link_cache(self.spider.settings.getint('AUTOUNIT_LINK_CACHE_SIZE'))
+        if cache is None:
+            return
+        # Rules are copied for each spider, so this doesn't change the class ones
+        for rule in self.spider._rules:
+            if not isinstance(rule.link_extractor, CachedLinkExtractor):
+                rule.link_extractor = CachedLinkExtractor(rule.link_extractor, cache)
+
+    def _build_response(self):
+        kwargs = dict(self.cassette.response)
+        response_cls = self._auto_import(kwargs.pop('cls', 'scrapy.http.HtmlResponse'))
+        return response_cls(**kwargs)
 
     def _http_objects(self):
-        request = request_from_dict(self.cassette.request, self.spider)
-        response_cls = self._auto_import(
-            self.cassette.response.pop('cls', 'scrapy.http.HtmlResponse')
-        )
-        response = response_cls(request=request, **self.cassette.response)
+        # The callback may change the request meta, so it's built from a copy
+        request = request_from_dict(copy.deepcopy(self.cassette.request), self.spider)
+        template = _responses.get(self.cassette)
+        if template is None:
+            template = _responses[self.cassette] = self._build_response()
+        # Responses share the body of the cached one, and text responses
+        # its encoding and decoded text, which are only worked out once.
+        # The text is kept by a Scrapy internal, so it's only shared with
+        # the Scrapy versions that have it
+        response = template.replace(request=request, flags=list(template.flags))
+        if isinstance(template, TextResponse) and hasattr(response, '_cached_ubody'):
+            response._cached_ubody = template.text
+        cache = get_selector_cache(self.spider.settings.getint('AUTOUNIT_SELECTOR_CACHE_SIZE'))
+        if cache is not None:
+            cache.attach(response)
         return request, response
 
     def _get_middlewares(self):
@@ -87,6 +137,8 @@ class Player(Parser):
         return as_dict
 
     def _compare(self, expected, found, message):
+        from testfixtures import compare
+
         x_label = "expected"
         y_label = "found"
 
@@ -101,7 +153,7 @@ class Player(Parser):
             prefix="{} ({})".format(message, self.cassette.filename),
         )
 
-    def _compare_items(self, index, found, expected):
+    def _compare_items(self, index, found, expected, followed_from=None):
         # Get recorded data and parse callback's output
         expected_type = expected['type']
         expected_data = expected['data']
@@ -120,13 +172,14 @@ class Player(Parser):
             self._filter_output_fields(found_data)
             self._filter_output_fields(expected_data)
 
-        self._compare(
-            expected=expected_data,
-            found=found_data,
-            message="Callback output #{} doesn't match recorded output".format(index),
-        )
+        if followed_from is not None and index > followed_from:
+            message = "Followed link #{} doesn't match recorded link".format(
+                index - followed_from)
+        else:
+            message = "Callback output #{} doesn't match recorded output".format(index)
+        self._compare(expected=expected_data, found=found_data, message=message)
 
-    def _compare_outputs(self, found, expected):
+    def _compare_outputs(self, found, expected, followed_from=None):
         out = []
         sentinel = object()
 
@@ -138,7 +191,7 @@ class Player(Parser):
                 raise AssertionError(
                     "Callback returned {} more item/s than expected ({})".format(
                         self._len(found), self.cassette.filename))
-            self._compare_items(index, found_item, expected_item)
+            self._compare_items(index, found_item, expected_item, followed_from)
 
         # Check if we expected more data than the found
         expected_more = next(expected, sentinel)
@@ -178,46 +231,67 @@ class Player(Parser):
         for attr in dont_test_attrs:
             attrs.pop(attr)
 
-    def _compare_attrs(self, attrs):
+    def _compare_attrs(self, attrs, expected):
         # Filter and compare attributes set by spider's init
-        self._filter_attrs(self.cassette.init_attrs)
+        self._filter_attrs(expected['init'])
         self._filter_attrs(attrs['init'])
         self._compare(
-            expected=self.cassette.init_attrs,
+            expected=expected['init'],
             found=attrs['init'],
             message="Init attributes not equal"
         )
 
         # Filter and compare spider attributes before the callback
-        self._filter_attrs(self.cassette.input_attrs)
+        self._filter_attrs(expected['input'])
         self._filter_attrs(attrs['input'])
         self._compare(
-            expected=self.cassette.input_attrs,
+            expected=expected['input'],
             found=attrs['input'],
             message="Input arguments not equal"
         )
 
         # Filter and compare spider attributes after callback
-        self._filter_attrs(self.cassette.output_attrs)
+        self._filter_attrs(expected['output'])
         self._filter_attrs(attrs['output'])
         self._compare(
-            expected=self.cassette.output_attrs,
+            expected=expected['output'],
             found=attrs['output'],
             message="Output arguments not equal"
         )
 
+    def _run_rule(self, rule, response, follow=True):
+        # The rule callback and the link extraction run separately, the
+        # same way CrawlSpider._callback runs them one after the other
+        spider_rule = self.spider._rules[rule['index']]
+        for elem in self.spider._parse_response(
+                response, spider_rule.callback, spider_rule.cb_kwargs, follow=False):
+            yield elem
+        if follow and spider_rule.follow and getattr(self.spider, '_follow_links', True):
+            for elem in self.spider._requests_to_follow(response):
+                yield elem
+
     def playback(self, compare=True):
         self._check_python_version()
         self._init_spider()
+        self._check_rules_support()
 
         for warning in self.deprecated_settings():
             print(warning)
 
+        # Recorded data is filtered and handed to the spider, so work on a
+        # copy of it to be able to play the cassette back again
+        expected = copy.deepcopy({
+            'init': self.cassette.init_attrs,
+            'input': self.cassette.input_attrs,
+            'output': self.cassette.output_attrs,
+            'data': self.cassette.output_data,
+        })
+
         attrs = {}
         attrs['init'] = self.spider_attrs()
 
         # Set spider attributes as they were before the callback
-        for k, v in self.cassette.input_attrs.items():
+        for k, v in expected['input'].items():
             setattr(self.spider, k, v)
 
         attrs['input'] = self.spider_attrs()
@@ -228,31 +302,54 @@ class Player(Parser):
         # Create middlewares instances
         middlewares = self._get_middlewares()
 
-        # Run middlewares process_spider_input methods
-        for mw in middlewares:
-            if hasattr(mw, 'process_spider_input'):
-                mw.process_spider_input(response, self.spider)
-
-        # Run the callback
-        cb_kwargs = getattr(request, "cb_kwargs", {})
-        cb_output = arg_to_iter(request.callback(response, **cb_kwargs))
-
-        # Run middlewares process_spider_output methods
-        middlewares.reverse()
-        for mw in middlewares:
-            if hasattr(mw, 'process_spider_output'):
-                cb_output = mw.process_spider_output(response, cb_output, self.spider)
-
-        found = iter(cb_output)
-        expected = iter(self.cassette.output_data)
-
+        # Freeze the clock the callback was recorded with
+        clock = None
+        if self.cassette.clock is not None:
+            clock = Clock.from_dict(self.cassette.clock, type(self.spider))
+            clock.start()
+        try:
+            # Run middlewares process_spider_input methods
+            for mw in middlewares:
+                if hasattr(mw, 'process_spider_input'):
+                    mw.process_spider_input(response, self.spider)
+
+            # Run the callback
+            rule = self.cassette.rule if isinstance(self.spider, CrawlSpider) else None
+            # Fixtures are always updated with the links followed
+            follow = not (
+                compare and self.spider.settings.getbool('AUTOUNIT_DONT_TEST_FOLLOWED_LINKS'))
+            if rule is not None:
+                cb_output = self._run_rule(rule, response, follow)
+                if not follow and rule['links']:
+                    expected['data'] = expected['data'][:-rule['links']]
+            else:
+                cb_kwargs = getattr(request, "cb_kwargs", {})
+                cb_output = arg_to_iter(request.callback(response, **cb_kwargs))
+
+            # Run middlewares process_spider_output methods
+            middlewares.reverse()
+            for mw in middlewares:
+                if hasattr(mw, 'process_spider_output'):
+                    cb_output = mw.process_spider_output(response, cb_output, self.spider)
+
+            found = iter(cb_output)
+
+            if compare:
+                followed_from = None
+                if rule is not None and follow:
+                    followed_from = len(expected['data']) - rule['links']
+                out = self._compare_outputs(found, iter(expected['data']), followed_from)
+            else:
+                # Exhaust the callback output so we can get output attributes
+                out = [x for x in found]
+        finally:
+            if clock is not None:
+                clock.stop()
+
+        attrs['output'] = self.spider_attrs()
         if compare:
-            out = self._compare_outputs(found, expected)
-            attrs['output'] = self.spider_attrs()
-            self._compare_attrs(attrs)
-        else:
-            # Exhaust the callback output so we can get output attributes
-            out = [x for x in found]
-            attrs['output'] = self.spider_attrs()
+            self._compare_attrs(attrs, expected)
+        elif rule is not None:
+            rule['links'] = self.count_followed(out)
 
         return iter(out), attrs
@@ -0,0 +1,138 @@
+import os
+import sys
+
+import pytest
+
+from .storage import PACK_FILENAME, fixture_exists, get_pack
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('autounit')
+    group.addoption(
+        '--autounit', action='store_true', default=False,
+        help='Collect scrapy-autounit fixtures directly as test items.')
+    parser.addini(
+        'autounit', type='bool', default=False,
+        help='Collect scrapy-autounit fixtures directly as test items.')
+
+
+def pytest_configure(config):
+    if config.getoption('autounit') or config.getini('autounit'):
+        config.pluginmanager.register(AutounitCollector(config), AutounitCollector.name)
+
+
+class AutounitCollector:
+    name = 'autounit-collector'
+
+    def __init__(self, config):
+        # Scrapy is only imported when the plugin is enabled
+        from scrapy.utils.project import inside_project, get_project_settings
+        from .manifest import Manifest
+        from .utils import get_base_path, get_project_dir, get_shard
+
+        if not inside_project():
+            raise pytest.UsageError('--autounit requires an active Scrapy project')
+        sys.path.append(get_project_dir())
+
+        self.settings = get_project_settings()
+        self.base_path = os.path.abspath(get_base_path(self.settings))
+        self.tests_dir = os.path.join(self.base_path, 'tests')
+        self.manifest = Manifest(self.base_path)
+        self.shard = get_shard()
+        self.spider_classes = {}
+
+    def pytest_ignore_collect(self, collection_path, config):
+        path = str(collection_path)
+        # Fixtures listed in the manifest don't need a directory walk
+        if path == self.tests_dir and self.manifest.exists():
+            return True
+        # Generated test modules would run the same fixtures again
+        if path.startswith(self.tests_dir) and os.path.basename(path) == 'test_fixtures.py':
+            return True
+        return None
+
+    def pytest_collect_file(self, file_path, parent):
+        path = str(file_path)
+        if path == self.manifest.path:
+            return ManifestFile.from_parent(parent, path=file_path)
+        if path.startswith(self.tests_dir + os.sep) and path.endswith('.bin'):
+            return FixtureFile.from_parent(parent, path=file_path)
+        if path.startswith(self.tests_dir + os.sep) and path.endswith(PACK_FILENAME):
+            return PackFile.from_parent(parent, path=file_path)
+        return None
+
+    def iter_fixtures(self, paths):
+        from .utils import in_shard
+
+        for path in paths:
+            parts = os.path.relpath(path, self.tests_dir).split(os.sep)
+            if len(parts) < 3:
+                continue
+            name = os.path.splitext(parts[-1])[0]
+            key = '{}__{}/{}'.format(parts[0], parts[-2], name)
+            if in_shard(key, self.shard):
+                yield '/'.join(parts[:-1] + [name]), path
+
+    def get_spider_class(self, spider_name):
+        from .utils import get_spider_class
+
+        if spider_name not in self.spider_classes:
+            self.spider_classes[spider_name] = get_spider_class(spider_name, self.settings)
+        return self.spider_classes[spider_name]
+
+
+class ManifestFile(pytest.File):
+    def collect(self):
+        collector = self.config.pluginmanager.get_plugin(AutounitCollector.name)
+        manifest = collector.manifest
+        paths = [manifest.get_path(key) for key in sorted(manifest.fixtures)]
+        paths = [path for path in paths if fixture_exists(path)]
+        for name, path in collector.iter_fixtures(paths):
+            yield FixtureItem.from_parent(self, name=name, fixture=path)
+
+
+class FixtureFile(pytest.File):
+    def collect(self):
+        collector = self.config.pluginmanager.get_plugin(AutounitCollector.name)
+        for _, path in collector.iter_fixtures([str(self.path)]):
+            name = os.path.splitext(os.path.basename(path))[0]
+            yield FixtureItem.from_parent(self, name=name, fixture=path)
+
+
+class PackFile(pytest.File):
+    def collect(self):
+        collector = self.config.pluginmanager.get_plugin(AutounitCollector.name)
+        callback_dir = os.path.dirname(str(self.path))
+        paths = [os.path.join(callback_dir, name) for name in sorted(get_pack(callback_dir).index)]
+        for _, path in collector.iter_fixtures(paths):
+            name = os.path.splitext(os.path.basename(path))[0]
+            yield FixtureItem.from_parent(self, name=name, fixture=path)
+
+
+class FixtureItem(pytest.Item):
+    def __init__(self, fixture, **kwargs):
+        super(FixtureItem, self).__init__(**kwargs)
+        self.fixture = fixture
+
+    def runtest(self):
+        from .cassette import Cassette
+        from .player import Player
+
+        collector = self.config.pluginmanager.get_plugin(AutounitCollector.name)
+        cassette = Cassette.from_fixture(self.fixture)
+        # Project settings and spider classes are shared by every fixture
+        # collected in the same worker
+        player = Player(
+            cassette,
+            spider_cls=collector.get_spider_class(cassette.spider_name),
+            settings=collector.settings,
+        )
+        player.playback()
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, AssertionError):
+            return str(excinfo.value)
+        return super(FixtureItem, self).repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.fixture, None, self.name
@@ -1,31 +1,47 @@
+import inspect
 import os
-import random
-import shutil
+import pickle
+import socket
 import sys
+import time
 
 from scrapy.commands.genspider import sanitize_module_name
+from scrapy.spiders import CrawlSpider
 
 from .cassette import Cassette
+from .clock import Clock
+from .manifest import Manifest
 from .parser import Parser
-from .utils import get_base_path
+from .sampling import get_sampler
+from .serialization import get_serialization
+from .storage import clear_fixtures, compact, get_format, open_database, write_fixture
+from .tracking import AttributeTracker
+from .utils import get_base_path, get_fingerprint, get_staging_dir
 
 
 TEST_TEMPLATE = """# THIS IS A GENERATED FILE
 # Generated by: {command}  # noqa: E501
 import os
 import unittest
-from glob import glob
 
 from scrapy_autounit.player import Player
+from scrapy_autounit.utils import get_fixture_tests
 
 
 class AutoUnit(unittest.TestCase):
-    def test__{test_name}(self):
-        _dir = os.path.dirname(os.path.abspath(__file__))
-        fixtures = glob(os.path.join(_dir, "*.bin"))
-        for fixture in fixtures:
-            player = Player.from_fixture(fixture)
-            player.playback()
+    pass
+
+
+def _fixture_test(fixture):
+    def test(self):
+        player = Player.from_fixture(fixture)
+        player.playback()
+    return test
+
+
+_dir = os.path.dirname(os.path.abspath(__file__))
+for _name, _fixture in get_fixture_tests(_dir, '{test_name}'):
+    setattr(AutoUnit, _name, _fixture_test(_fixture))
 
 
 if __name__ == '__main__':
@@ -33,6 +49,10 @@ if __name__ == '__main__':
 """
 
 
+def get_max_fixtures(settings):
+    return max(settings.getint('AUTOUNIT_MAX_FIXTURES_PER_CALLBACK', default=10), 10)
+
+
 class Recorder(Parser):
     def __init__(self, spider):
         self.spider = spider
@@ -40,22 +60,43 @@ class Recorder(Parser):
         self.spider_name = sanitize_module_name(spider.name)
         self.spider_init_attrs = self.spider_attrs()
 
-        self.fixture_counters = {}
         self._set_max_fixtures()
+        self.sampler = get_sampler(self.settings, self.max_fixtures)
+        self.max_output_items = self.settings.getint('AUTOUNIT_MAX_OUTPUT_ITEMS', 0)
+        self.fixture_format = get_format(self.settings)
+        self.serialization = get_serialization(self.settings)
+        self.packed_dirs = set()
+        self.freeze_time = self.settings.getbool('AUTOUNIT_FREEZE_TIME')
+        self.seed_random = self.settings.getbool('AUTOUNIT_SEED_RANDOM')
+        self.clocks = {}
+        self.input_attrs = {}
+
+        self.tracker = None
+        if (self.settings.getbool('AUTOUNIT_TRACK_SPIDER_ATTRS') and
+                self.settings.getint('CONCURRENT_REQUESTS') > 1):
+            self.tracker = AttributeTracker(spider)
 
         self.base_path = get_base_path(self.settings)
-        self._create_dir(self.base_path, exist_ok=True)
+        self.staging = self.settings.getbool('AUTOUNIT_STAGING')
+        if self.staging:
+            # Every process records into its own directory, combined
+            # afterwards with `autounit merge`
+            name = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), int(time.time() * 1000))
+            self.base_path = os.path.join(get_staging_dir(self.base_path), name)
+        self._create_dir(self.base_path, parents=self.staging, exist_ok=True)
+        self.manifest = Manifest(self.base_path)
+        if self.staging:
+            self.manifest.max_fixtures[self.spider.name] = self.max_fixtures
+        if self.fixture_format == 'sqlite':
+            open_database(self.base_path)
         self._clear_fixtures()
 
     @classmethod
     def update_fixture(cls, cassette, path):
-        with open(path, 'wb') as outfile:
-            outfile.write(cassette.pack())
+        write_fixture(path, cassette.pack_chunks(), cassette=cassette)
 
     def _set_max_fixtures(self):
-        self.max_fixtures = self.settings.getint('AUTOUNIT_MAX_FIXTURES_PER_CALLBACK', default=10)
-        if self.max_fixtures < 10:
-            self.max_fixtures = 10
+        self.max_fixtures = get_max_fixtures(self.settings)
 
     def _get_test_dir(self, callback_name):
         components = [self.base_path, 'tests', self.spider_name]
@@ -84,7 +125,8 @@ class Recorder(Parser):
 
     def _clear_fixtures(self):
         path = os.path.join(self.base_path, 'tests', self.spider_name)
-        shutil.rmtree(path, ignore_errors=True)
+        clear_fixtures(path)
+        self.manifest.discard(path)
 
     def _get_fixture_name(self, index):
         default_name = 'fixture%s.bin' % index
@@ -108,8 +150,16 @@ class Recorder(Parser):
         filename = self._get_fixture_name(index)
         path = os.path.join(test_dir, filename)
         cassette.filename = filename
-        with open(path, 'wb') as outfile:
-            outfile.write(cassette.pack())
+        try:
+            data = cassette.pack_chunks(self.serialization)
+        except TypeError as e:
+            self.spider.logger.warning('Fixture {} not recorded: {}'.format(path, e))
+            self.spider.crawler.stats.inc_value('autounit/skipped/unserializable')
+            return
+        write_fixture(path, data, self.fixture_format, cassette)
+        if self.fixture_format == 'pack':
+            self.packed_dirs.add(test_dir)
+        self.manifest.add(path, cassette)
 
     def _write_test(self, path, callback_name):
         command = 'scrapy {}'.format(' '.join(sys.argv))
@@ -119,40 +169,133 @@ class Recorder(Parser):
         with open(str(test_path), 'w') as f:
             f.write(test_code)
 
+    def close(self):
+        # Drop the fixtures replaced while sampling
+        for test_dir in self.packed_dirs:
+            compact(test_dir)
+        self.manifest.save()
+        if self.tracker:
+            self.tracker.uninstall()
+
+    def _is_generator_callback(self, request):
+        # CrawlSpider callbacks are always called from a generator
+        if isinstance(self.spider, CrawlSpider):
+            return True
+        callback = request.callback or self.spider.parse
+        return inspect.isgeneratorfunction(getattr(callback, '__wrapped__', callback))
+
+    def _snapshot_attrs(self):
+        return pickle.loads(pickle.dumps(self.spider_attrs(), protocol=2))
+
+    def _wrap_callback(self, response_obj, clock):
+        # Callbacks are called later on by Scrapy, and other callbacks may
+        # run in between, so spider attributes are snapshotted again and
+        # the clock started right when the callback runs. The clock runs
+        # again while the output is consumed.
+        request = response_obj.request
+        original = request.callback
+        callback = original or getattr(self.spider, '_parse', self.spider.parse)
+        key = id(response_obj)
+        tracker = self.tracker
+
+        def autounit_callback(*args, **kwargs):
+            # Put back before the callback runs, so requests copied from
+            # this one don't carry the wrapper
+            request.callback = original
+            if tracker:
+                tracker.start(key)
+                self.input_attrs[key] = self._snapshot_attrs()
+            if clock is not None:
+                clock.start()
+            try:
+                if tracker:
+                    return tracker.run(key, callback, *args, **kwargs)
+                return callback(*args, **kwargs)
+            finally:
+                if clock is not None:
+                    clock.stop()
+
+        autounit_callback.__wrapped__ = callback
+        autounit_callback.autounit_original = original
+        request.callback = autounit_callback
+
+    def discard(self, response_obj):
+        key = id(response_obj)
+        self.clocks.pop(key, None)
+        self.input_attrs.pop(key, None)
+        if self.tracker:
+            self.tracker.finish(key)
+        request = response_obj.request
+        if hasattr(request.callback, 'autounit_original'):
+            request.callback = request.callback.autounit_original
+
     def new_cassette(self, response_obj):
         request, response = self.parse_response(response_obj)
+        clock = None
+        if self.freeze_time or self.seed_random:
+            clock = Clock.new(self.freeze_time, self.seed_random, type(self.spider))
+            self.clocks[id(response_obj)] = clock
+        if self.tracker or clock is not None:
+            self._wrap_callback(response_obj, clock)
         return Cassette(
             spider=self.spider,
             request=request,
             response=response,
             init_attrs=self.spider_init_attrs,
             input_attrs=self.spider_attrs(),
+            fingerprint=get_fingerprint(response_obj.request, self.spider.crawler),
+            rule=self.get_rule(response_obj.request),
+            clock=clock.to_dict() if clock is not None else None,
         )
 
-    def record(self, cassette, output):
-        original, parsed = self.parse_callback_output(output)
+    def record(self, cassette, output, response_obj=None):
+        key = id(response_obj)
+        input_attrs = self.input_attrs.pop(key, None)
+        if input_attrs is not None:
+            cassette.input_attrs = input_attrs
+        # Cassettes recorded without their response aren't tracked
+        tracker = self.tracker if response_obj is not None else None
+        interleaved = tracker.finish(key) if tracker else False
+        if interleaved and self._is_generator_callback(response_obj.request):
+            # Generator callbacks only run while their output is consumed
+            # below, without other callbacks running in between, so their
+            # input attributes can be snapshotted again right before that
+            cassette.input_attrs = self._snapshot_attrs()
+            interleaved = False
+        if tracker:
+            output = tracker.iterate(key, output)
+
+        clock = self.clocks.pop(key, None)
+        if clock is not None:
+            clock.start()
+        try:
+            original, parsed = self.parse_callback_output(output, limit=self.max_output_items)
+        finally:
+            if clock is not None:
+                clock.stop()
+        if parsed is None:
+            self.spider.crawler.stats.inc_value('autounit/skipped/output_count')
+            return original
+        if interleaved:
+            self.spider.crawler.stats.inc_value('autounit/skipped/interleaved')
+            return original
+
+        if cassette.rule is not None and cassette.rule['follow']:
+            original = list(original)
+            cassette.rule['links'] = self.count_followed(original)
+            original = iter(original)
 
         cassette.output_data = parsed
         cassette.output_attrs = self.spider_attrs()
 
         callback_name = cassette.request['callback']
-        callback_counter = self.fixture_counters.setdefault(callback_name, 0)
-        self.fixture_counters[callback_name] += 1
-
         test_dir = self._get_test_dir(callback_name)
 
-        index = 0
-        if callback_counter < self.max_fixtures:
-            index = callback_counter + 1
-        else:
-            r = random.randint(0, callback_counter)
-            if r < self.max_fixtures:
-                index = r + 1
-
+        index = self.sampler.sample(callback_name, cassette)
         if index != 0:
             self._add_sample(index, test_dir, cassette)
 
-        if index == 1:
+        if index == 1 and not self.staging:
             self._write_test(test_dir, callback_name)
 
         return original
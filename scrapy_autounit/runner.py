@@ -0,0 +1,356 @@
+import binascii
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+from multiprocessing.connection import Client, Listener
+
+from scrapy.commands.genspider import sanitize_module_name
+from scrapy.utils.misc import walk_modules
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.spider import iter_spider_classes
+
+from .cassette import Cassette
+from .player import Player
+from .storage import list_fixtures
+from .utils import get_base_path, get_project_dir, get_spider_class
+
+try:
+    from importlib import reload
+except ImportError:
+    pass
+
+
+class Runner:
+    """
+    Replays fixtures keeping the Scrapy project and its spiders loaded.
+    """
+    def __init__(self, settings=None):
+        self.settings = settings or get_project_settings()
+        self.project_dir = os.path.join(get_project_dir(), '')
+        self.base_path = os.path.abspath(get_base_path(self.settings))
+        self.spider_classes = {}
+        self.mtimes = {}
+        self.import_project()
+
+    def _project_modules(self):
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if not path or not path.startswith(self.project_dir):
+                continue
+            if path.startswith(self.base_path) or 'site-packages' in path:
+                continue
+            yield name, module, self._source(path)
+
+    def _source(self, path):
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        return path
+
+    def _mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def import_project(self):
+        for spider_module in self.settings.getlist('SPIDER_MODULES'):
+            walk_modules(spider_module)
+        for name, _, path in self._project_modules():
+            self.mtimes[name] = self._mtime(path)
+
+    def reload(self):
+        changed = []
+        for name, module, path in self._project_modules():
+            mtime = self._mtime(path)
+            if name in self.mtimes and mtime != self.mtimes[name]:
+                changed.append(name)
+            self.mtimes[name] = mtime
+        if not changed:
+            return changed
+
+        for name in changed:
+            reload(sys.modules[name])
+        # Spider modules are reloaded too, so they pick up the new
+        # version of any project module they import names from
+        spider_modules = tuple(self.settings.getlist('SPIDER_MODULES'))
+        for name, module, _ in self._project_modules():
+            if name not in changed and name.startswith(spider_modules):
+                reload(module)
+        self.spider_classes.clear()
+        return changed
+
+    def get_spider_class(self, spider_name):
+        if spider_name not in self.spider_classes:
+            self.spider_classes[spider_name] = get_spider_class(spider_name, self.settings)
+        return self.spider_classes[spider_name]
+
+    def run(self, path):
+        result = {'fixture': path, 'status': 'passed', 'message': None}
+        start = time.time()
+        try:
+            cassette = Cassette.from_fixture(path)
+            player = Player(
+                cassette,
+                spider_cls=self.get_spider_class(cassette.spider_name),
+                settings=self.settings,
+            )
+            player.playback()
+        except AssertionError as e:
+            result.update(status='failed', message=str(e))
+        except Exception:
+            result.update(status='error', message=traceback.format_exc())
+        result['duration'] = time.time() - start
+        return result
+
+
+_worker_runner = None
+
+
+def _init_worker():
+    global _worker_runner
+    _worker_runner = Runner()
+
+
+def _run_worker(path):
+    return _worker_runner.run(path)
+
+
+def run_parallel(fixtures, jobs):
+    """
+    Play fixtures with `jobs` processes, each keeping its own runner.
+    """
+    pool = Pool(jobs, initializer=_init_worker)
+    try:
+        return pool.map(_run_worker, fixtures, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _code_digest(code):
+    # Only what the code does is hashed, so moving a method around the
+    # file doesn't make it look changed
+    digest = hashlib.sha1(code.co_code)
+    digest.update(repr((code.co_names, code.co_varnames)).encode('utf-8'))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            digest.update(_code_digest(const).encode('ascii'))
+        else:
+            digest.update(repr(const).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _digest(value, depth=0):
+    value = getattr(value, '__func__', value)
+    if isinstance(value, property):
+        return repr([_digest(f, depth) for f in (value.fget, value.fset, value.fdel)])
+    code = getattr(value, '__code__', None)
+    if code is not None:
+        return _code_digest(code)
+    if isinstance(value, type):
+        return '{}.{}'.format(value.__module__, value.__name__)
+    if depth < 3:
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return repr([_digest(v, depth + 1) for v in value])
+        if isinstance(value, dict):
+            return repr(sorted((repr(k), _digest(v, depth + 1)) for k, v in value.items()))
+        if type(value).__repr__ is object.__repr__ and hasattr(value, '__dict__'):
+            # Objects without their own repr, like crawling rules, would
+            # otherwise look different every time their module is reloaded
+            return repr((type(value).__name__, _digest(vars(value), depth + 1)))
+    return repr(value)
+
+
+def get_class_digests(cls):
+    """
+    Return a digest of every attribute of a spider class, including the
+    inherited ones, skipping those defined by Scrapy itself.
+    """
+    digests = {}
+    for klass in cls.__mro__:
+        if klass is object or klass.__module__.split('.')[0] == 'scrapy':
+            continue
+        for name, value in vars(klass).items():
+            if name not in digests and name not in ('__dict__', '__weakref__', '__doc__'):
+                digests[name] = _digest(value)
+    return digests
+
+
+def get_module_digests(module):
+    digests = {}
+    for name, value in vars(module).items():
+        if name.startswith('__') or isinstance(value, type(sys)):
+            continue
+        if getattr(value, '__module__', module.__name__) != module.__name__:
+            # Imported names are checked in their own modules
+            continue
+        if isinstance(value, type):
+            digests[name] = repr(sorted(get_class_digests(value).items()))
+        else:
+            digests[name] = _digest(value)
+    return digests
+
+
+class Watcher:
+    """
+    Finds the fixtures affected by the project modules changed on disk.
+
+    Spiders are compared attribute by attribute before and after reloading
+    them: when only callbacks changed just their fixtures are returned,
+    otherwise all the fixtures of the spider are. Changes to project
+    modules other than the spider modules affect every fixture.
+    """
+    def __init__(self, runner):
+        self.runner = runner
+        self.spider_modules = tuple(runner.settings.getlist('SPIDER_MODULES'))
+        self.tests_dir = os.path.join(runner.base_path, 'tests')
+        self.digests = self._get_digests()
+
+    def _get_digests(self):
+        spiders, modules = {}, {}
+        for module_name in self.spider_modules:
+            for module in walk_modules(module_name):
+                module_digests = get_module_digests(module)
+                for spider_cls in iter_spider_classes(module):
+                    module_digests.pop(spider_cls.__name__, None)
+                    spiders[spider_cls.name] = (module.__name__, get_class_digests(spider_cls))
+                modules[module.__name__] = module_digests
+        return spiders, modules
+
+    def _get_affected(self, changed, old, new):
+        # Maps the affected spiders to their changed attributes, or to
+        # None when all their callbacks are affected
+        if any(not name.startswith(self.spider_modules) for name in changed):
+            return None
+        old_spiders, old_modules = old
+        new_spiders, new_modules = new
+        changed_modules = set(
+            name for name in set(old_modules) | set(new_modules)
+            if old_modules.get(name) != new_modules.get(name))
+        affected = {}
+        for spider in set(old_spiders) | set(new_spiders):
+            if spider not in old_spiders or spider not in new_spiders:
+                affected[spider] = None
+                continue
+            old_module, old_attrs = old_spiders[spider]
+            new_module, new_attrs = new_spiders[spider]
+            if old_module != new_module or new_module in changed_modules:
+                affected[spider] = None
+                continue
+            attrs = set(
+                name for name in set(old_attrs) | set(new_attrs)
+                if old_attrs.get(name) != new_attrs.get(name))
+            if attrs:
+                affected[spider] = attrs
+        return affected
+
+    def _get_fixtures(self, affected):
+        spiders = {}
+        for spider, attrs in (affected or {}).items():
+            spiders[sanitize_module_name(spider)] = attrs
+        fixtures = {}
+        for root, _, _ in os.walk(self.tests_dir):
+            rel_parts = os.path.relpath(root, self.tests_dir).split(os.sep)
+            if affected is not None and rel_parts[0] not in spiders:
+                continue
+            for path in list_fixtures(root):
+                # Fixtures are stored in tests/<spider>/[extra path/]<callback>
+                fixtures.setdefault(rel_parts[0], {}).setdefault(rel_parts[-1], []).append(path)
+
+        found = []
+        for spider, callbacks in fixtures.items():
+            attrs = None if affected is None else spiders[spider]
+            if attrs is not None and not attrs <= set(callbacks):
+                # A method or attribute other than a callback changed
+                attrs = None
+            for callback, paths in callbacks.items():
+                if attrs is None or callback in attrs:
+                    found.extend(paths)
+        return sorted(found)
+
+    def poll(self):
+        """
+        Reload the changed project modules and return their names together
+        with the fixtures to play again.
+        """
+        changed = self.runner.reload()
+        if not changed:
+            return changed, []
+        digests = self._get_digests()
+        affected = self._get_affected(changed, self.digests, digests)
+        self.digests = digests
+        return changed, self._get_fixtures(affected)
+
+
+def get_server_file(base_path):
+    return os.path.join(base_path, 'server.json')
+
+
+def serve(runner):
+    """
+    Accept fixture paths from `autounit play` until the server is stopped.
+    """
+    server_file = get_server_file(runner.base_path)
+    authkey = binascii.hexlify(os.urandom(16))
+    listener = Listener(('127.0.0.1', 0), authkey=authkey)
+    fd = os.open(server_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({
+            'address': list(listener.address),
+            'authkey': authkey.decode('ascii'),
+            'pid': os.getpid(),
+        }, f)
+    print('Serving fixtures on {}:{}'.format(*listener.address))
+    try:
+        while True:
+            conn = listener.accept()
+            try:
+                message = conn.recv()
+                if message.get('command') == 'stop':
+                    conn.send([])
+                    break
+                fixtures = message.get('fixtures', [])
+                try:
+                    changed = runner.reload()
+                except Exception:
+                    error = traceback.format_exc()
+                    conn.send([
+                        {'fixture': path, 'status': 'error', 'message': error, 'duration': 0}
+                        for path in fixtures
+                    ])
+                    continue
+                if changed:
+                    print('Reloaded: {}'.format(', '.join(changed)))
+                conn.send([runner.run(path) for path in fixtures])
+            except (EOFError, IOError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+        os.remove(server_file)
+
+
+def connect(base_path):
+    server_file = get_server_file(base_path)
+    if not os.path.isfile(server_file):
+        return None
+    with open(server_file) as f:
+        server = json.load(f)
+    try:
+        return Client(tuple(server['address']), authkey=server['authkey'].encode('ascii'))
+    except (IOError, OSError):
+        # Stale file from a server that didn't shut down cleanly
+        return None
+
+
+def send(conn, message):
+    try:
+        conn.send(message)
+        return conn.recv()
+    finally:
+        conn.close()
@@ -0,0 +1,104 @@
+import hashlib
+import random
+
+
+def get_sampling_key(fingerprint, seed):
+    # Map a request fingerprint to a number in [0, 1) that only depends
+    # on the fingerprint and the seed
+    data = '{}:{}'.format(seed, fingerprint).encode('utf-8')
+    return int(hashlib.sha1(data).hexdigest()[:13], 16) / float(16 ** 13)
+
+
+class Sampler:
+    """
+    Decides which fixtures to keep for each callback.
+
+    Every cassette gets a sampling key and the ones with the lowest keys
+    are kept, which is a uniform sample when keys are random. Keys derived
+    from a seeded hash of the request fingerprint make the sample
+    reproducible. When features to stratify by are given, fixtures are
+    split evenly between the strata of responses sharing them.
+    """
+    def __init__(self, max_fixtures, stratify_by=(), seed=None):
+        self.max_fixtures = max_fixtures
+        self.seed = seed
+        self.features = []
+        for name in stratify_by:
+            feature = getattr(self, '_' + name, None)
+            if feature is None:
+                raise ValueError("Unknown sampling stratum '{}'".format(name))
+            self.features.append(feature)
+        self.slots = {}
+
+    def _status(self, cassette):
+        return cassette.response['status']
+
+    def _response_class(self, cassette):
+        return cassette.response.get('cls')
+
+    def _item_count(self, cassette):
+        count = sum(1 for out in cassette.output_data if out['type'] == 'item')
+        # Buckets: 0, 1, 2-3, 4-7, 8-15...
+        return count.bit_length()
+
+    def _output_types(self, cassette):
+        return tuple(sorted(set(out['type'] for out in cassette.output_data)))
+
+    def _shape(self, cassette):
+        shapes = set()
+        for out in cassette.output_data:
+            data = out['data']
+            if out['type'] == 'item' and hasattr(data, 'keys'):
+                shapes.add(tuple(sorted(str(k) for k in data.keys())))
+        return tuple(sorted(shapes))
+
+    def get_stratum(self, cassette):
+        return tuple(feature(cassette) for feature in self.features)
+
+    def get_key(self, cassette):
+        if self.seed is None or cassette.fingerprint is None:
+            return random.random()
+        return get_sampling_key(cassette.fingerprint, self.seed)
+
+    def sample(self, callback_name, cassette):
+        # Return the fixture index to store the cassette in, 0 to drop it
+        stratum = self.get_stratum(cassette)
+        key = self.get_key(cassette)
+        # Fixture index -> (stratum, key)
+        slots = self.slots.setdefault(callback_name, {})
+
+        if self.seed is not None and (stratum, key) in slots.values():
+            # Same request recorded again
+            return 0
+
+        if len(slots) < self.max_fixtures:
+            index = len(slots) + 1
+            slots[index] = (stratum, key)
+            return index
+
+        kept = {}
+        for index, (slot_stratum, slot_key) in slots.items():
+            kept.setdefault(slot_stratum, []).append((slot_key, index))
+        largest = max(kept, key=lambda s: len(kept[s]))
+        own = kept.get(stratum, [])
+
+        if len(own) < len(kept[largest]) - 1:
+            # Under-represented stratum, take a slot from the largest one
+            _, index = max(kept[largest])
+        elif not own:
+            return 0
+        else:
+            # Keep the samples with the lowest keys within the stratum
+            slot_key, index = max(own)
+            if key >= slot_key:
+                return 0
+        slots[index] = (stratum, key)
+        return index
+
+
+def get_sampler(settings, max_fixtures):
+    return Sampler(
+        max_fixtures,
+        stratify_by=settings.getlist('AUTOUNIT_SAMPLING_STRATIFY_BY'),
+        seed=settings.get('AUTOUNIT_SAMPLING_SEED'),
+    )
@@ -0,0 +1,220 @@
+import base64
+import datetime
+import decimal
+import json
+import re
+
+from scrapy import Item
+
+
+FORMAT = 'scrapy-autounit'
+VERSION = 1
+TYPE_KEY = '__type__'
+SERIALIZATIONS = ('pickle', 'json')
+
+# Text and integers are unicode and long on Python 2, where str is bytes
+_TEXT = type(u'')
+_SCALARS = frozenset([_TEXT, int, type(2 ** 64), float, bool, type(None)])
+_TEXT_KEYS = frozenset([_TEXT])
+_types = []
+_encoders = {}
+_decoders = {}
+
+
+def register_type(cls, name, encode, decode):
+    """
+    Make instances of `cls` serializable to JSON fixtures.
+
+    `encode` turns an instance into serializable data, which may contain
+    other registered types, and `decode` builds the instance back from it.
+    """
+    _types.insert(0, (cls, name, encode))
+    _decoders[name] = decode
+    _encoders.clear()
+
+
+def _get_encoder(cls):
+    if cls not in _encoders:
+        for registered_cls, name, encode in _types:
+            if issubclass(cls, registered_cls):
+                _encoders[cls] = (name, encode)
+                break
+        else:
+            raise TypeError(
+                "Can't serialize objects of type '{}.{}' to JSON fixtures, register it with "
+                "scrapy_autounit.serialization.register_type or use "
+                "AUTOUNIT_SERIALIZATION = 'pickle'".format(cls.__module__, cls.__name__))
+    return _encoders[cls]
+
+
+def encode(obj):
+    # Scalars are checked before calling encode for them, which is most of
+    # the encoding time otherwise
+    cls = type(obj)
+    if cls in _SCALARS:
+        return obj
+    if cls is list:
+        return [x if type(x) in _SCALARS else encode(x) for x in obj]
+    if cls is dict:
+        if TYPE_KEY not in obj and _TEXT_KEYS.issuperset(map(type, obj)):
+            return {k: v if type(v) in _SCALARS else encode(v) for k, v in obj.items()}
+        return {TYPE_KEY: 'dict', 'value': [[encode(k), encode(v)] for k, v in obj.items()]}
+    name, encoder = _get_encoder(cls)
+    return {TYPE_KEY: name, 'value': encode(encoder(obj))}
+
+
+def _decode_object(obj):
+    name = obj.get(TYPE_KEY)
+    if name is None:
+        return obj
+    if name == 'dict':
+        return {k: v for k, v in obj['value']}
+    if name not in _decoders:
+        raise ValueError("Unknown type '{}' in JSON fixture".format(name))
+    return _decoders[name](obj['value'])
+
+
+def dumps(data):
+    return json.dumps(
+        {'format': FORMAT, 'version': VERSION, 'data': encode(data)},
+        separators=(',', ':'),
+    ).encode('utf-8')
+
+
+def loads(binary):
+    loaded = json.loads(binary.decode('utf-8'), object_hook=_decode_object)
+    if loaded.get('format') != FORMAT:
+        raise ValueError('Not a scrapy-autounit JSON fixture')
+    if loaded.get('version', 0) > VERSION:
+        raise ValueError(
+            'JSON fixture version {} is not supported by this version of '
+            'scrapy-autounit'.format(loaded['version']))
+    return loaded['data']
+
+
+def get_serialization(settings):
+    serialization = settings.get('AUTOUNIT_SERIALIZATION', 'pickle')
+    if serialization not in SERIALIZATIONS:
+        raise ValueError("Unknown serialization '{}', expected one of: {}".format(
+            serialization, ', '.join(SERIALIZATIONS)))
+    return serialization
+
+
+def _sorted(values):
+    # Sets are stored sorted so that equal cassettes give equal fixtures
+    try:
+        return sorted(values)
+    except TypeError:
+        return sorted(values, key=repr)
+
+
+def _class_path(cls):
+    return '{}.{}'.format(cls.__module__, getattr(cls, '__qualname__', cls.__name__))
+
+
+def _encode_item(item):
+    return {'class': _class_path(type(item)), 'fields': dict(item)}
+
+
+def _item_classes():
+    classes = {}
+    pending = [Item]
+    while pending:
+        cls = pending.pop()
+        classes[_class_path(cls)] = cls
+        pending.extend(cls.__subclasses__())
+    return classes
+
+
+# Whether the spider modules were imported to find item classes
+_spider_modules_loaded = []
+
+
+def _load_spider_modules():
+    from scrapy.utils.misc import walk_modules
+    from scrapy.utils.project import get_project_settings
+
+    _spider_modules_loaded.append(True)
+    for module in get_project_settings().getlist('SPIDER_MODULES'):
+        walk_modules(module)
+
+
+def _decode_item(value):
+    # Fixtures can only name item classes that are already defined, or
+    # defined once the spider modules of the project are imported, so no
+    # other module is ever imported because a fixture says so
+    cls = _item_classes().get(value['class'])
+    if cls is None and not _spider_modules_loaded:
+        _load_spider_modules()
+        cls = _item_classes().get(value['class'])
+    if cls is None:
+        raise ValueError("'{}' is not a known item class".format(value['class']))
+    return cls(value['fields'])
+
+
+_TIME_RE = re.compile(
+    r'^(\d{2}):(\d{2}):(\d{2})(?:\.(\d{6}))?'
+    r'(?:([+-])(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{6}))?)?)?$')
+
+
+class _FixedOffset(datetime.tzinfo):
+    # For Pythons without datetime.timezone
+    def __init__(self, offset):
+        self.offset = offset
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+
+def _decode_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _decode_time(value):
+    # The inverse of time.isoformat, which fromisoformat isn't available
+    # for on every supported Python
+    match = _TIME_RE.match(value)
+    if not match:
+        raise ValueError("Invalid time '{}' in JSON fixture".format(value))
+    (hour, minute, second, microsecond, sign,
+     tz_hours, tz_minutes, tz_seconds, tz_microseconds) = match.groups()
+    tzinfo = None
+    if sign:
+        offset = datetime.timedelta(
+            hours=int(tz_hours), minutes=int(tz_minutes), seconds=int(tz_seconds or 0),
+            microseconds=int(tz_microseconds or 0))
+        if sign == '-':
+            offset = -offset
+        timezone = getattr(datetime, 'timezone', None)
+        tzinfo = timezone(offset) if timezone else _FixedOffset(offset)
+    return datetime.time(
+        int(hour), int(minute), int(second), int(microsecond or 0), tzinfo=tzinfo)
+
+
+def _decode_datetime(value):
+    date, _, time = value.partition('T')
+    return datetime.datetime.combine(_decode_date(date), _decode_time(time))
+
+
+register_type(
+    bytes, 'bytes',
+    lambda b: base64.b64encode(b).decode('ascii'),
+    lambda s: base64.b64decode(s.encode('ascii')))
+register_type(tuple, 'tuple', list, tuple)
+register_type(set, 'set', _sorted, set)
+register_type(frozenset, 'frozenset', _sorted, frozenset)
+register_type(decimal.Decimal, 'decimal', str, decimal.Decimal)
+register_type(
+    datetime.timedelta, 'timedelta',
+    lambda d: [d.days, d.seconds, d.microseconds],
+    lambda v: datetime.timedelta(*v))
+register_type(datetime.time, 'time', datetime.time.isoformat, _decode_time)
+register_type(datetime.date, 'date', datetime.date.isoformat, _decode_date)
+register_type(datetime.datetime, 'datetime', datetime.datetime.isoformat, _decode_datetime)
+register_type(Item, 'item', _encode_item, _decode_item)
@@ -0,0 +1,453 @@
+import errno
+import os
+import shutil
+import struct
+from glob import glob
+
+from .utils import replace_file
+
+
+PACK_FILENAME = 'fixtures.pack'
+FORMATS = ('files', 'pack', 'sqlite')
+
+
+class Pack:
+    """
+    Append-only file holding the fixtures of a callback.
+
+    Every record is a header with the name and data lengths followed by
+    both. Writing a fixture again appends a new record and deleting it
+    appends one without data, so the offset index built from the headers
+    always points to the latest version of each fixture.
+    """
+    MAGIC = b'AUTOUNIT PACK 1\n'
+    HEADER = struct.Struct('>II')
+    DELETED = 0xffffffff
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        # Where the last complete record ends
+        self.end = None
+        self.index = self._load_index()
+
+    def _load_index(self):
+        index = {}
+        if not os.path.isfile(self.path):
+            return index
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("'{}' is not a fixture pack".format(self.path))
+            self.end = f.tell()
+            while True:
+                # Stops at the record left incomplete by an interrupted write
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    break
+                name_len, data_len = self.HEADER.unpack(header)
+                name = f.read(name_len)
+                if len(name) < name_len:
+                    break
+                name = name.decode('utf-8')
+                if data_len == self.DELETED:
+                    index.pop(name, None)
+                    self.records += 1
+                    self.end = f.tell()
+                    continue
+                offset = f.tell()
+                if offset + data_len > size:
+                    break
+                f.seek(data_len, os.SEEK_CUR)
+                index[name] = (offset, data_len)
+                self.records += 1
+                self.end = offset + data_len
+        return index
+
+    def _append(self, name, data, data_len):
+        name = name.encode('utf-8')
+        new = not os.path.isfile(self.path)
+        if not new and self.end is not None and os.path.getsize(self.path) > self.end:
+            # Appended records would be read as part of an incomplete one
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.end)
+        with open(self.path, 'ab') as f:
+            if new:
+                f.write(self.MAGIC)
+            f.write(self.HEADER.pack(len(name), data_len))
+            f.write(name)
+            offset = f.tell()
+            f.write(data)
+            self.end = f.tell()
+        self.records += 1
+        return offset
+
+    def read(self, name):
+        offset, length = self.index[name]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def write(self, name, data):
+        self.index[name] = (self._append(name, data, len(data)), len(data))
+
+    def delete(self, name):
+        if name in self.index:
+            self._append(name, b'', self.DELETED)
+            del self.index[name]
+
+    def compact(self):
+        # Rewrite the pack without overwritten and deleted records
+        if self.records == len(self.index):
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC)
+        compacted = Pack(tmp_path)
+        for name in sorted(self.index):
+            compacted.write(name, self.read(name))
+        replace_file(tmp_path, self.path)
+        self.index = compacted.index
+        self.records = compacted.records
+
+
+class Database:
+    """
+    SQLite store for the fixtures recorded under an autounit base path.
+
+    Fixtures are kept next to indexed metadata columns, so they can be
+    selected without loading them.
+    """
+    FILENAME = 'fixtures.sqlite3'
+    COLUMNS = (
+        ('spider', 'TEXT'),
+        ('callback', 'TEXT'),
+        ('fingerprint', 'TEXT'),
+        ('method', 'TEXT'),
+        ('url', 'TEXT'),
+        ('status', 'INTEGER'),
+        ('response_class', 'TEXT'),
+        ('body_size', 'INTEGER'),
+        ('items', 'INTEGER'),
+        ('requests', 'INTEGER'),
+        ('size', 'INTEGER'),
+    )
+
+    def __init__(self, base_path):
+        import sqlite3
+
+        self.base_path = base_path
+        self.path = os.path.join(base_path, self.FILENAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        columns = ''.join(', {} {}'.format(name, kind) for name, kind in self.COLUMNS)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS fixtures (dir TEXT NOT NULL, name TEXT NOT NULL'
+                '{}, data BLOB NOT NULL, PRIMARY KEY (dir, name))'.format(columns))
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS fixtures_callback ON fixtures (spider, callback)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS fixtures_status ON fixtures (status)')
+
+    def _dir(self, path):
+        return os.path.relpath(path, self.base_path).replace(os.sep, '/')
+
+    def _key(self, path):
+        return self._dir(os.path.dirname(path)), os.path.basename(path)
+
+    def names(self, callback_dir):
+        rows = self.conn.execute(
+            'SELECT name FROM fixtures WHERE dir = ?', (self._dir(callback_dir),))
+        return [row['name'] for row in rows]
+
+    def exists(self, path):
+        row = self.conn.execute(
+            'SELECT 1 FROM fixtures WHERE dir = ? AND name = ?', self._key(path)).fetchone()
+        return row is not None
+
+    def read(self, path):
+        row = self.conn.execute(
+            'SELECT data FROM fixtures WHERE dir = ? AND name = ?', self._key(path)).fetchone()
+        return None if row is None else bytes(row['data'])
+
+    def size(self, path):
+        row = self.conn.execute(
+            'SELECT length(data) AS size FROM fixtures WHERE dir = ? AND name = ?',
+            self._key(path)).fetchone()
+        return None if row is None else row['size']
+
+    def write(self, path, data, metadata):
+        names = [name for name, _ in self.COLUMNS]
+        values = [metadata.get(name) for name in names]
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO fixtures (dir, name, {}, data) VALUES ({})'.format(
+                    ', '.join(names), ', '.join('?' * (len(names) + 3))),
+                self._key(path) + tuple(values) + (memoryview(data),))
+
+    def delete(self, path):
+        with self.conn:
+            self.conn.execute('DELETE FROM fixtures WHERE dir = ? AND name = ?', self._key(path))
+
+    def clear(self, path):
+        # Delete every fixture under a directory
+        prefix = self._dir(path) + '/'
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM fixtures WHERE dir = ? OR substr(dir, 1, ?) = ?',
+                (prefix[:-1], len(prefix), prefix))
+
+    def query(self, path=None, where=None, params=()):
+        names = ['dir', 'name'] + [name for name, _ in self.COLUMNS]
+        conditions, args = [], []
+        if path is not None:
+            prefix = self._dir(path) + '/'
+            conditions.append('(dir = ? OR substr(dir, 1, ?) = ?)')
+            args.extend([prefix[:-1], len(prefix), prefix])
+        if where:
+            conditions.append('({})'.format(where))
+            args.extend(params)
+        sql = 'SELECT {} FROM fixtures'.format(', '.join(names))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        for row in self.conn.execute(sql + ' ORDER BY dir, name', args):
+            fixture = dict(zip(names, row))
+            dir_path = os.path.join(self.base_path, *fixture.pop('dir').split('/'))
+            fixture['path'] = os.path.join(dir_path, fixture.pop('name'))
+            yield fixture
+
+
+def get_metadata(cassette):
+    output = cassette.output_data or []
+    return {
+        'spider': cassette.spider_name,
+        'callback': cassette.request['callback'],
+        'fingerprint': cassette.fingerprint,
+        'method': cassette.request.get('method'),
+        'url': cassette.request.get('url'),
+        'status': cassette.response.get('status'),
+        'response_class': cassette.response.get('cls'),
+        'body_size': len(cassette.response.get('body') or b''),
+        'items': sum(1 for out in output if out['type'] == 'item'),
+        'requests': sum(1 for out in output if out['type'] == 'request'),
+    }
+
+
+_packs = {}
+_databases = {}
+_no_database = set()
+
+
+def _pack_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def get_pack(callback_dir):
+    # Packs are cached while they don't change on disk, so reading every
+    # fixture of a callback only builds its index once
+    path = os.path.join(callback_dir, PACK_FILENAME)
+    try:
+        version = _pack_version(path)
+    except OSError:
+        _packs.pop(path, None)
+        return None
+    cached = _packs.get(path)
+    if cached is None or cached[0] != version:
+        cached = _packs[path] = (version, Pack(path))
+    return cached[1]
+
+
+def _update_pack(pack):
+    # The index of a pack is kept up to date by its own writes, so the
+    # cached one stays valid instead of being built again from the file
+    _packs[pack.path] = (_pack_version(pack.path), pack)
+
+
+def _database_key(base_path):
+    # SQLite connections can't be used across fork, so processes forked
+    # after opening them, like pool workers, open their own
+    return os.getpid(), os.path.abspath(base_path)
+
+
+def open_database(base_path):
+    key = _database_key(base_path)
+    if key not in _databases:
+        _databases[key] = Database(key[1])
+        _no_database.clear()
+    return _databases[key]
+
+
+def close_database(base_path):
+    database = _databases.pop(_database_key(base_path), None)
+    if database is not None:
+        database.conn.close()
+
+
+def get_database(path):
+    # The database of a fixture is the closest one up its directories
+    path = os.path.abspath(path)
+    checked = []
+    while path not in _no_database:
+        database_path = os.path.join(path, Database.FILENAME)
+        if _database_key(path) in _databases or os.path.isfile(database_path):
+            return open_database(path)
+        checked.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    _no_database.update(checked)
+    return None
+
+
+def get_format(settings):
+    fixture_format = settings.get('AUTOUNIT_FIXTURE_FORMAT', 'files')
+    if fixture_format not in FORMATS:
+        raise ValueError("Unknown fixture format '{}', expected one of: {}".format(
+            fixture_format, ', '.join(FORMATS)))
+    return fixture_format
+
+
+def _locate(path):
+    if os.path.isfile(path):
+        return 'files'
+    callback_dir, name = os.path.split(path)
+    pack = get_pack(callback_dir)
+    if pack is not None and name in pack.index:
+        return 'pack'
+    database = get_database(callback_dir)
+    if database is not None and database.exists(path):
+        return 'sqlite'
+    return None
+
+
+def _read(location, path):
+    callback_dir, name = os.path.split(path)
+    if location == 'files':
+        with open(path, 'rb') as f:
+            return f.read()
+    if location == 'pack':
+        return get_pack(callback_dir).read(name)
+    return get_database(callback_dir).read(path)
+
+
+def _write(location, path, data, cassette=None):
+    # Data is either bytes or an iterator of chunks, which are only
+    # written one at a time to files
+    callback_dir, name = os.path.split(path)
+    if location == 'files':
+        # Written aside and moved in place, so an interrupted write
+        # doesn't leave a truncated fixture behind
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for chunk in [data] if isinstance(data, bytes) else data:
+                f.write(chunk)
+        replace_file(tmp_path, path)
+        return
+    if not isinstance(data, bytes):
+        data = b''.join(data)
+    if location == 'pack':
+        pack = get_pack(callback_dir) or Pack(os.path.join(callback_dir, PACK_FILENAME))
+        pack.write(name, data)
+        _update_pack(pack)
+    else:
+        database = get_database(callback_dir)
+        if database is None:
+            raise IOError(errno.ENOENT, 'No fixtures database found', path)
+        from .cassette import Cassette
+
+        if cassette is None:
+            cassette = Cassette.unpack(data)
+        metadata = get_metadata(cassette) if isinstance(cassette, Cassette) else {}
+        metadata['size'] = len(data)
+        database.write(path, data, metadata)
+
+
+def _delete(location, path):
+    callback_dir, name = os.path.split(path)
+    if location == 'files':
+        os.remove(path)
+    elif location == 'pack':
+        pack = get_pack(callback_dir)
+        pack.delete(name)
+        _update_pack(pack)
+    elif location == 'sqlite':
+        get_database(callback_dir).delete(path)
+
+
+def list_fixtures(callback_dir):
+    fixtures = set(glob(os.path.join(callback_dir, '*.bin')))
+    pack = get_pack(callback_dir)
+    if pack is not None:
+        fixtures.update(os.path.join(callback_dir, name) for name in pack.index)
+    database = get_database(callback_dir)
+    if database is not None:
+        fixtures.update(os.path.join(callback_dir, name) for name in database.names(callback_dir))
+    return sorted(fixtures)
+
+
+def fixture_exists(path):
+    return _locate(path) is not None
+
+
+def fixture_size(path):
+    # Taken from the file or the pack index, without reading the fixture
+    location = _locate(path)
+    if location is None:
+        raise IOError(errno.ENOENT, 'No such fixture', path)
+    callback_dir, name = os.path.split(path)
+    if location == 'files':
+        return os.path.getsize(path)
+    if location == 'pack':
+        return get_pack(callback_dir).index[name][1]
+    return get_database(callback_dir).size(path)
+
+
+def read_fixture(path):
+    location = _locate(path)
+    if location is None:
+        raise IOError(errno.ENOENT, 'No such fixture', path)
+    return _read(location, path)
+
+
+def write_fixture(path, data, fixture_format=None, cassette=None):
+    # Fixtures are updated where they are, new ones go to the given
+    # format or to the pack of the callback if there is one
+    location = _locate(path) or fixture_format
+    if location is None:
+        location = 'pack' if get_pack(os.path.dirname(path)) else 'files'
+    _write(location, path, data, cassette)
+
+
+def delete_fixture(path):
+    _delete(_locate(path), path)
+
+
+def clear_fixtures(path):
+    # Delete every fixture under a directory
+    shutil.rmtree(path, ignore_errors=True)
+    database = get_database(path)
+    if database is not None:
+        database.clear(path)
+
+
+def compact(callback_dir, fixture_format=None):
+    """
+    Compact the pack of a callback, moving its fixtures to the given format.
+    """
+    if fixture_format:
+        for path in list_fixtures(callback_dir):
+            location = _locate(path)
+            if location != fixture_format:
+                _write(fixture_format, path, _read(location, path))
+                _delete(location, path)
+    pack = get_pack(callback_dir)
+    if pack is None:
+        return
+    if not pack.index:
+        os.remove(pack.path)
+        _packs.pop(pack.path, None)
+        return
+    pack.compact()
+    _update_pack(pack)
@@ -0,0 +1,103 @@
+import json
+import os
+import re
+
+from .utils import replace_file
+
+
+# Duration assumed for fixtures that were never played
+DEFAULT_DURATION = 0.1
+# Weight of the latest run in the average duration of a fixture
+SMOOTHING = 0.3
+
+_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value):
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smh]?)\s*$', value)
+    if not match:
+        raise ValueError("Invalid duration '{}', expected e.g. '90s' or '5m'".format(value))
+    return float(match.group(1)) * _UNITS[match.group(2)]
+
+
+class Timings:
+    """
+    History of how long fixtures take to play back and how often they
+    fail, stored as JSON in the autounit base path.
+    """
+    FILENAME = 'timings.json'
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.path = os.path.join(base_path, self.FILENAME)
+        self.fixtures = self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get_key(self, path):
+        return os.path.relpath(path, self.base_path).replace(os.sep, '/')
+
+    def get_duration(self, path):
+        entry = self.fixtures.get(self.get_key(path))
+        if entry is not None:
+            return entry['duration']
+        known = sorted(entry['duration'] for entry in self.fixtures.values())
+        return known[len(known) // 2] if known else DEFAULT_DURATION
+
+    def get_failure_rate(self, path):
+        # Fixtures that never ran count as failing half of the time
+        entry = self.fixtures.get(self.get_key(path), {'runs': 0, 'failures': 0})
+        return (entry['failures'] + 1.0) / (entry['runs'] + 2)
+
+    def update(self, results):
+        # Merged with the timings saved by other runs meanwhile
+        fixtures = self._load()
+        for result in results:
+            key = self.get_key(result['fixture'])
+            entry = fixtures.get(key)
+            if entry is None:
+                entry = fixtures[key] = {
+                    'runs': 0, 'failures': 0, 'duration': result['duration']}
+            entry['runs'] += 1
+            entry['failures'] += result['status'] != 'passed'
+            entry['duration'] += SMOOTHING * (result['duration'] - entry['duration'])
+        self.fixtures = fixtures
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(fixtures, f, indent=1, sort_keys=True)
+        replace_file(tmp_path, self.path)
+
+    def select(self, fixtures, budget, jobs=1):
+        """
+        Choose the fixtures to play within `budget` seconds using `jobs`
+        processes, returning them with their estimated duration.
+
+        At least one fixture is chosen for each callback. The remaining
+        time goes to the fixtures most likely to fail per second spent
+        playing them, so fixtures that failed before or never ran are
+        favoured over slow ones that always pass.
+        """
+        scored = []
+        for path in fixtures:
+            duration = self.get_duration(path)
+            score = self.get_failure_rate(path) / max(duration, 0.001)
+            scored.append((score, path, duration))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+
+        selected, total, callbacks = [], 0.0, set()
+        for score, path, duration in scored:
+            if os.path.dirname(path) not in callbacks:
+                callbacks.add(os.path.dirname(path))
+                selected.append(path)
+                total += duration
+        capacity = budget * jobs
+        chosen = set(selected)
+        for score, path, duration in scored:
+            if path not in chosen and total + duration <= capacity:
+                selected.append(path)
+                total += duration
+        return sorted(selected), total / jobs
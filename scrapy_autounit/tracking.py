@@ -0,0 +1,82 @@
+class AttributeTracker:
+    """
+    Keeps track of spider attribute writes while callbacks run concurrently.
+
+    Writes are caught by swapping the class of the spider for a subclass
+    of it, which is undone by `uninstall`.
+    """
+    def __init__(self, spider):
+        self.spider = spider
+        self.spider_cls = type(spider)
+        self.active = None
+        self.pending = {}
+        self._install()
+
+    def _install(self):
+        tracker = self
+        spider_cls = self.spider_cls
+
+        class TrackedSpider(spider_cls):
+            def __setattr__(self, name, value):
+                tracker.wrote()
+                super(TrackedSpider, self).__setattr__(name, value)
+
+            def __delattr__(self, name):
+                tracker.wrote()
+                super(TrackedSpider, self).__delattr__(name)
+
+        TrackedSpider.__name__ = spider_cls.__name__
+        TrackedSpider.__module__ = spider_cls.__module__
+        if hasattr(spider_cls, '__qualname__'):
+            TrackedSpider.__qualname__ = spider_cls.__qualname__
+        self.spider.__class__ = TrackedSpider
+
+    def uninstall(self):
+        self.spider.__class__ = self.spider_cls
+
+    def wrote(self):
+        for key, invocation in self.pending.items():
+            if self.active is None:
+                invocation['unowned'] = True
+            elif self.active != key:
+                invocation['foreign'] = True
+
+    def start(self, key):
+        for invocation in self.pending.values():
+            invocation['shared'] = True
+        self.pending[key] = {
+            'shared': bool(self.pending),
+            'unowned': False,
+            'foreign': False,
+        }
+
+    def finish(self, key):
+        # Tell if attributes may have been modified by other invocations
+        # since this one started. Writes made while another invocation was
+        # iterating its output belong to it, while writes made outside of
+        # any iteration can't be told apart when several are in flight.
+        invocation = self.pending.pop(key, None)
+        if invocation is None:
+            return False
+        if invocation['foreign']:
+            return True
+        return invocation['shared'] and invocation['unowned']
+
+    def run(self, key, callback, *args, **kwargs):
+        previous, self.active = self.active, key
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            self.active = previous
+
+    def iterate(self, key, output):
+        iterator = iter(output)
+        while True:
+            previous, self.active = self.active, key
+            try:
+                elem = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.active = previous
+            yield elem
@@ -1,9 +1,15 @@
+import binascii
 import os
+import re
+import zlib
+from datetime import datetime
 from importlib import import_module
 from itertools import islice
 
+from scrapy import Item
 from scrapy.utils.conf import closest_scrapy_cfg, init_env
 from scrapy.utils.misc import walk_modules
+from scrapy.utils.python import to_unicode
 from scrapy.utils.spider import iter_spider_classes
 
 
@@ -14,6 +20,10 @@ def get_base_path(settings):
     )
 
 
+def get_staging_dir(base_path):
+    return os.path.join(base_path, 'staging')
+
+
 def get_project_dir():
     closest_cfg = closest_scrapy_cfg()
     if closest_cfg:
@@ -31,6 +41,17 @@ def get_project_dir():
         return None
 
 
+def replace_file(src, dst):
+    # os.replace doesn't exist on Python 2, where renaming over an
+    # existing file is only atomic, and allowed, on POSIX
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
 def get_spider_class(spider_name, project_settings):
     spider_modules = project_settings.get('SPIDER_MODULES')
     for spider_module in spider_modules:
@@ -42,6 +63,67 @@ def get_spider_class(spider_name, project_settings):
     return None
 
 
+def get_fingerprint(request, crawler=None):
+    fingerprinter = getattr(crawler, 'request_fingerprinter', None)
+    if fingerprinter is not None:
+        return binascii.hexlify(fingerprinter.fingerprint(request)).decode('ascii')
+    from scrapy.utils.request import request_fingerprint
+    return request_fingerprint(request)
+
+
+def get_shard(value=None):
+    # Shards are given as INDEX/TOTAL (e.g. 3/8), with indexes starting at 1
+    if value is None:
+        value = os.environ.get('AUTOUNIT_SHARD')
+    if not value:
+        return None
+    try:
+        index, total = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard '{}', expected INDEX/TOTAL".format(value))
+    if total < 1 or not 1 <= index <= total:
+        raise ValueError("Invalid shard '{}', INDEX must be between 1 and TOTAL".format(value))
+    return index, total
+
+
+def in_shard(key, shard):
+    if shard is None:
+        return True
+    index, total = shard
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % total == index - 1
+
+
+def get_fixture_tests(path, test_name, shard=None):
+    shard = shard or get_shard()
+    tests = []
+    from .storage import list_fixtures
+
+    for fixture in list_fixtures(path):
+        fixture_name = os.path.splitext(os.path.basename(fixture))[0]
+        if not in_shard('{}/{}'.format(test_name, fixture_name), shard):
+            continue
+        method_name = 'test__{}__{}'.format(test_name, re.sub(r'\W', '_', fixture_name))
+        tests.append((method_name, fixture))
+    return tests
+
+
+def parse_data(data):
+    if isinstance(data, (dict, Item)):
+        return {
+            parse_data(k): parse_data(v)
+            for k, v in data.items()
+        }
+    elif isinstance(data, list):
+        return [parse_data(x) for x in data]
+    elif isinstance(data, bytes):
+        return to_unicode(data)
+    elif isinstance(data, datetime):
+        return data.isoformat()
+    elif isinstance(data, (int, float, str)):
+        return data
+    return repr(data)
+
+
 def generate_test(fixture_path, encoding='utf-8'):
     raise AssertionError(
         "This spider's tests and fixtures are from an old version and need to be updated. "
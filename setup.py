@@ -23,9 +23,15 @@ setuptools.setup(
     install_requires=[
         'testfixtures==6.14.1',
     ],
+    extras_require={
+        'pytest': ['pytest>=7'],
+    },
     entry_points = {
         'console_scripts': [
             'autounit=scrapy_autounit.cli:main',
         ],
+        'pytest11': [
+            'autounit=scrapy_autounit.plugin',
+        ],
     },
 )
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+import unittest
+
+
+def loaded_modules(statement):
+    code = '{}\nimport sys\nprint("\\n".join(sys.modules))'.format(statement)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return set(out.decode('utf-8').splitlines())
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_middleware(self):
+        modules = loaded_modules('import scrapy_autounit')
+        self.assertIn('scrapy_autounit.middleware', modules)
+        self.assertNotIn('scrapy_autounit.recorder', modules)
+        self.assertNotIn('scrapy_autounit.cassette', modules)
+
+    def test_cli(self):
+        modules = loaded_modules('import scrapy_autounit.cli')
+        self.assertNotIn('scrapy_autounit.player', modules)
+        self.assertNotIn('scrapy_autounit.recorder', modules)
+        self.assertNotIn('scrapy.crawler', modules)
+
+    def test_player(self):
+        modules = loaded_modules('import scrapy_autounit.player')
+        self.assertNotIn('testfixtures', modules)
@@ -1,9 +1,12 @@
+import json
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import time
 import unittest
+import zlib
 
 
 SPIDER_TEMPLATE = '''
@@ -36,6 +39,18 @@ class MySpider(scrapy.Spider):
 '''
 
 
+def has_pytest():
+    # The plugin needs pytest 7, which the oldest supported Pythons can't install
+    try:
+        import pytest
+    except ImportError:
+        return False
+    return int(pytest.__version__.split('.')[0]) >= 7
+
+
+HAS_PYTEST = has_pytest()
+
+
 def run(*pargs, **kwargs):
     proc = subprocess.Popen(*pargs, **kwargs)
     stdout, stderr = proc.communicate()
@@ -148,7 +163,7 @@ class CaseSpider(object):
                 second_callback=self._second_callback
             ))
 
-    def record(self, args=None, settings=None, record_verbosity=False):
+    def record(self, args=None, settings=None, record_verbosity=False, expect_tests=True):
         if self._start_requests is None or self._parse is None:
             raise AssertionError()
         self._write_spider()
@@ -172,17 +187,18 @@ class CaseSpider(object):
         check_process('Running spider failed!', result)
         if record_verbosity:
             print_test_output(result)
-        if not any(
+        if expect_tests and not any(
             any(f.endswith('.py') and f != '__init__.py' for f in files)
             for _, _, files in os.walk(os.path.join(self.dir, 'autounit'))
         ):
             process_error('No autounit tests recorded!', result)
 
-    def test(self, test_verbosity=True):
+    def test(self, test_verbosity=True, env_vars=None):
         if self._start_requests is None or self._parse is None:
             raise AssertionError()
         env = os.environ.copy()
         env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+        env.update(env_vars or {})
         result = run(
             ['python', '-m', 'unittest', 'discover', '-v'],
             env=env,
@@ -201,6 +217,72 @@ class CaseSpider(object):
             )
         if test_verbosity:
             print_test_output(result)
+        return tests_ran
+
+    def autounit(self, *args, **kwargs):
+        env = os.environ.copy()
+        env['PYTHONPATH'] = self.dir
+        env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+        result = run(
+            ['autounit'] + list(args),
+            env=env,
+            cwd=self.dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        if kwargs.get('check', True):
+            check_process('Autounit command failed!', result)
+        return result['stdout'].decode('utf-8')
+
+    def pytest(self, *args):
+        env = os.environ.copy()
+        env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+        result = run(
+            ['python', '-m', 'pytest', '--autounit'] + list(args),
+            env=env,
+            cwd=self.dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        check_process('Pytest failed!', result)
+        out = result['stdout'].decode('utf-8')
+        return int(re.search('([0-9]+) passed', out).group(1))
+
+
+class CrawlCaseSpider(CaseSpider):
+    link_extractor = "LinkExtractor(allow='item')"
+    spider_body = ''
+
+    def __init__(self):
+        super(CrawlCaseSpider, self).__init__()
+        pages = os.path.join(self.dir, 'pages')
+        os.mkdir(pages)
+        for name, body in [
+            ('index', '<a href="item1.html">1</a><a href="item2.html">2</a>'),
+            ('item1', '<h1>One</h1><a href="item2.html">2</a>'),
+            ('item2', '<h1>Two</h1><a href="item1.html">1</a>'),
+        ]:
+            with open(os.path.join(pages, name + '.html'), 'w') as f:
+                f.write('<html><body>{}</body></html>'.format(body))
+        self.imports("""
+from scrapy.linkextractors import LinkExtractor
+from scrapy.spiders import CrawlSpider, Rule
+        """)
+        self.start_requests(
+            "yield scrapy.Request('file://%s')" % os.path.join(pages, 'index.html'))
+        self.parse("pass")
+        self.second_callback("yield {'title': response.css('h1::text').get()}")
+
+    @property
+    def template(self):
+        # CrawlSpider.parse handles the start requests with older Scrapy versions
+        template = super(CrawlCaseSpider, self).template.replace(
+            'class MySpider(scrapy.Spider):', 'class MySpider(CrawlSpider):').replace(
+            'def parse(self, response):', 'def parse_start_url(self, response):')
+        return template.replace("    name = '{name}'\n", (
+            "    name = '{name}'\n"
+            "    rules = (Rule(%s, callback='second_callback', follow=True),)\n"
+        ) % self.link_extractor + self.spider_body.replace('{', '{{').replace('}', '}}'))
 
 
 class TestRecording(unittest.TestCase):
@@ -214,6 +296,918 @@ class TestRecording(unittest.TestCase):
             spider.record()
             spider.test()
 
+    def test_one_test_per_fixture(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            spider.record()
+            self.assertEqual(spider.test(), 3)
+            sharded = [
+                spider.test(env_vars={'AUTOUNIT_SHARD': '{}/2'.format(i)})
+                for i in (1, 2)
+            ]
+            self.assertEqual(sum(sharded), 3)
+
+    @unittest.skipUnless(HAS_PYTEST, 'pytest 7 or newer is not installed')
+    def test_pytest_plugin(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            spider.record()
+            self.assertEqual(spider.pytest(), 3)
+            os.remove(os.path.join(spider.dir, 'autounit', 'manifest.json'))
+            self.assertEqual(spider.pytest(), 3)
+
+    def test_play_command(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            spider.record()
+            out = spider.autounit('play', '-s', 'myspider')
+            self.assertIn('Played 3 fixture(s), 0 failed', out)
+            out = spider.autounit('play', '-s', 'myspider', '-c', 'parse', '-f', '2')
+            self.assertIn('Played 1 fixture(s), 0 failed', out)
+
+    def test_play_budget(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+                if response.url.endswith('0'):
+                    yield scrapy.Request('data:text/plain,x', callback=self.second_callback)
+            """)
+            spider.second_callback("yield {'b': 2}")
+            spider.record()
+            out = spider.autounit('play', '--budget', '0s')
+            self.assertIn('Playing 2 of 4 fixture(s)', out)
+            self.assertIn('Played 2 fixture(s), 0 failed', out)
+            self.assertIn('/second_callback/', out)
+            with open(os.path.join(spider.dir, 'autounit', 'timings.json')) as f:
+                timings = json.load(f)
+            self.assertEqual(len(timings), 2)
+            self.assertTrue(all(t['runs'] == 1 for t in timings.values()))
+
+            out = spider.autounit('play', '--budget', '5m', '-j', '2')
+            self.assertIn('Playing 4 of 4 fixture(s)', out)
+            self.assertIn('Played 4 fixture(s), 0 failed', out)
+            with open(os.path.join(spider.dir, 'autounit', 'timings.json')) as f:
+                self.assertEqual(len(json.load(f)), 4)
+
+    def test_crawl_spider_rules(self):
+        from scrapy_autounit.cassette import Cassette
+
+        with CrawlCaseSpider() as spider:
+            spider.record(settings=dict(AUTOUNIT_RECORD_CALLBACKS='second_callback'))
+            callback_dir = os.path.join(
+                spider.dir, 'autounit', 'tests', 'myspider', 'second_callback')
+            cassette = Cassette.from_fixture(os.path.join(callback_dir, 'fixture1.bin'))
+            self.assertEqual(cassette.rule, {'index': 0, 'follow': True, 'links': 1})
+            self.assertEqual(len(cassette.output_data), 2)
+            self.assertEqual(spider.test(), 2)
+
+            spider.link_extractor = "LinkExtractor(allow='nothing')"
+            spider._write_spider()
+            with self.assertRaisesRegexp(AssertionError, 'Expected 1 more item'):
+                spider.test()
+            spider.custom_settings("AUTOUNIT_DONT_TEST_FOLLOWED_LINKS=True,")
+            spider._write_spider()
+            self.assertEqual(spider.test(), 2)
+
+    def test_crawl_spider_rules_compatibility(self):
+        from scrapy_autounit.cassette import Cassette
+
+        with CrawlCaseSpider() as spider:
+            # Scrapy versions before CrawlSpider._callback followed links
+            # through CrawlSpider._response_downloaded
+            spider.spider_body = """
+    _callback = None
+
+    def _response_downloaded(self, response):
+        return CrawlSpider._callback(self, response)
+
+    def _build_request(self, rule_index, link):
+        request = CrawlSpider._build_request(self, rule_index, link)
+        return request.replace(callback=self._response_downloaded)
+"""
+            spider.record(settings=dict(AUTOUNIT_RECORD_CALLBACKS='second_callback'))
+            callback_dir = os.path.join(
+                spider.dir, 'autounit', 'tests', 'myspider', 'second_callback')
+            cassette = Cassette.from_fixture(os.path.join(callback_dir, 'fixture1.bin'))
+            self.assertEqual(cassette.rule, {'index': 0, 'follow': True, 'links': 1})
+            self.assertEqual(spider.test(), 2)
+
+            # Without the CrawlSpider internals rule fixtures can't be played
+            spider.spider_body = "    _requests_to_follow = None\n"
+            spider._write_spider()
+            with self.assertRaisesRegexp(AssertionError, "Can't play back CrawlSpider rule"):
+                spider.test()
+
+    def test_migrate_command(self):
+        import pickle
+        from scrapy_autounit.cassette import Cassette
+
+        with CaseSpider() as spider:
+            spider.set_init("self.page = 1")
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("yield {'a': response.url}")
+            spider.record()
+            callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+            for name in ('fixture1.bin', 'fixture2.bin'):
+                path = os.path.join(callback_dir, name)
+                cassette = Cassette.from_fixture(path)
+                legacy = {
+                    'spider_name': cassette.spider_name,
+                    'request': cassette.request,
+                    'response': cassette.response,
+                    'result': cassette.output_data,
+                    'middlewares': cassette.middlewares,
+                    'settings': cassette.included_settings,
+                    'spider_args_in': cassette.input_attrs,
+                    'spider_args_out': cassette.output_attrs,
+                }
+                with open(path, 'wb') as f:
+                    f.write(zlib.compress(pickle.dumps(legacy, protocol=2)))
+
+            # Fixtures listed in the journal of an interrupted migration are skipped
+            journal_path = os.path.join(spider.dir, 'autounit', 'migrate.journal')
+            with open(journal_path, 'w') as f:
+                f.write('tests/myspider/parse/fixture2.bin\n')
+            out = spider.autounit('migrate', '-j', '2')
+            self.assertIn('Migrated 1 fixture(s), 1 already up to date, 0 failed', out)
+            self.assertFalse(os.path.exists(journal_path))
+            cassette = Cassette.from_fixture(os.path.join(callback_dir, 'fixture1.bin'))
+            self.assertIsInstance(cassette, Cassette)
+            self.assertEqual(cassette.init_attrs, {'page': 1})
+
+            out = spider.autounit('migrate', '-s', 'myspider')
+            self.assertIn('Migrated 1 fixture(s), 2 already up to date, 0 failed', out)
+            self.assertEqual(spider.test(), 3)
+
+    def test_frozen_clock(self):
+        from scrapy_autounit.cassette import Cassette
+
+        with CaseSpider() as spider:
+            spider.imports("""
+import datetime
+import random
+import time
+from datetime import date, datetime as dt
+from random import randint
+            """)
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                now = dt.now()
+                yield {
+                    'now': now,
+                    'is_datetime': isinstance(now, dt),
+                    'utcnow': datetime.datetime.utcnow().isoformat(),
+                    'today': date.today(),
+                    'time': time.time(),
+                    'random': random.random(),
+                    'randint': randint(0, 10 ** 9),
+                }
+            """)
+            spider.record(settings=dict(AUTOUNIT_FREEZE_TIME=True, AUTOUNIT_SEED_RANDOM=True))
+            callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+            cassette = Cassette.from_fixture(os.path.join(callback_dir, 'fixture1.bin'))
+            self.assertEqual(set(cassette.clock), {'time', 'seed'})
+            item = cassette.output_data[0]['data']
+            self.assertEqual(item['time'], cassette.clock['time'])
+            self.assertTrue(item['is_datetime'])
+            self.assertEqual(spider.test(), 3)
+
+    def test_frozen_clock_copied_request(self):
+        with CaseSpider() as spider:
+            spider.start_requests("yield scrapy.Request('data:text/plain,1')")
+            spider.parse("""
+                if not response.meta.get('retried'):
+                    yield response.request.replace(dont_filter=True, meta={'retried': True})
+                else:
+                    yield {'time': time.time()}
+            """)
+            spider.imports("import time")
+            spider.record(settings=dict(AUTOUNIT_FREEZE_TIME=True))
+            self.assertEqual(spider.test(), 2)
+
+    def test_gc_command(self):
+        with CaseSpider() as spider:
+            spider.imports("import random")
+            spider.start_requests("""
+                for n in (10, 200, 20000):
+                    body = ''.join(random.choice('0123456789abcdef') for _ in range(n))
+                    yield scrapy.Request('data:text/plain,' + body)
+            """)
+            spider.parse("""
+                yield {'a': len(response.body)}
+                yield scrapy.Request('data:text/plain,1', callback=self.second_callback)
+            """)
+            spider.second_callback("yield {'b': 2}")
+            spider.record(settings=dict(CONCURRENT_REQUESTS=1))
+            tests_dir = os.path.join(spider.dir, 'autounit', 'tests')
+            parse_dir = os.path.join(tests_dir, 'myspider', 'parse')
+            shutil.copytree(parse_dir, os.path.join(tests_dir, 'myspider', 'old_callback'))
+            shutil.copytree(
+                os.path.join(tests_dir, 'myspider'), os.path.join(tests_dir, 'gone_spider'))
+            shutil.copy(
+                os.path.join(parse_dir, 'fixture1.bin'), os.path.join(parse_dir, 'fixture4.bin'))
+            sizes = dict(
+                (name, os.path.getsize(os.path.join(parse_dir, name)))
+                for name in os.listdir(parse_dir) if name.endswith('.bin'))
+            biggest = max(sizes, key=sizes.get)
+
+            out = spider.autounit('gc', '--max-size', '5k', '--dry-run')
+            self.assertIn('ORPHANED SPIDER autounit/tests/gone_spider', out)
+            self.assertIn('ORPHANED CALLBACK autounit/tests/myspider/old_callback', out)
+            self.assertIn('DUPLICATE (SAME DATA) autounit/tests/myspider/parse/fixture4.bin', out)
+            self.assertIn('OVERSIZED autounit/tests/myspider/parse/' + biggest, out)
+            self.assertIn('Would remove 4 item(s)', out)
+            self.assertTrue(os.path.isdir(os.path.join(tests_dir, 'gone_spider')))
+
+            out = spider.autounit('gc', '--max-size', '5k')
+            self.assertIn('Removed 4 item(s)', out)
+            self.assertEqual(sorted(os.listdir(tests_dir)), ['__init__.py', 'myspider'])
+            self.assertEqual(
+                sorted(f for f in os.listdir(parse_dir) if f.endswith('.bin')),
+                sorted(set(sizes) - {'fixture4.bin', biggest}))
+            self.assertEqual(spider.test(), 3)
+
+            out = spider.autounit('gc', '--spider-budget', '1')
+            self.assertIn('Removed 1 item(s)', out)
+            self.assertEqual(spider.test(), 2)
+
+    def test_gc_same_request(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request(
+                        'data:text/plain,1', meta={'i': i}, dont_filter=True)
+            """)
+            spider.parse("yield {'i': response.meta['i']}")
+            spider.record()
+            out = spider.autounit('gc', '--dry-run')
+            self.assertIn('Would remove 0 item(s)', out)
+            out = spider.autounit('gc', '--same-request')
+            self.assertEqual(out.count('DUPLICATE (SAME REQUEST)'), 2)
+            self.assertEqual(spider.test(), 1)
+
+    def test_sectioned_fixtures(self):
+        from scrapy_autounit.cassette import CHUNK_SIZE, SECTIONS_MAGIC, Cassette
+
+        with CaseSpider() as spider:
+            page = os.path.join(spider.dir, 'page.json')
+            with open(page, 'w') as f:
+                f.write(json.dumps([{'id': i, 'name': 'item %s' % i} for i in range(60000)]))
+            spider.start_requests("""
+                yield scrapy.Request('file://%s')
+                yield scrapy.Request('data:text/plain,small')
+            """ % page)
+            spider.parse("yield {'size': len(response.body)}")
+            spider.record(settings=dict(AUTOUNIT_MAX_FIXTURES_PER_CALLBACK=2))
+            callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+            fixtures = {}
+            for name in ('fixture1.bin', 'fixture2.bin'):
+                path = os.path.join(callback_dir, name)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                fixtures[data.startswith(SECTIONS_MAGIC)] = Cassette.from_fixture(path)
+            self.assertEqual(set(fixtures), {True, False})
+
+            cassette = fixtures[True]
+            with open(page, 'rb') as f:
+                self.assertEqual(cassette.response['body'], f.read())
+            self.assertEqual(
+                cassette.output_data[0]['data'], {'size': len(cassette.response['body'])})
+            self.assertLessEqual(max(len(c) for c in cassette.pack_chunks()), CHUNK_SIZE)
+            self.assertEqual(Cassette.unpack(cassette.pack()).response, cassette.response)
+            self.assertEqual(spider.test(), 2)
+
+    def test_serve_command(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("yield {'a': response.url}")
+            spider.record()
+            env = os.environ.copy()
+            env['PYTHONPATH'] = spider.dir
+            env['PYTHONUNBUFFERED'] = '1'
+            env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+            output_path = os.path.join(spider.dir, 'serve.log')
+            server_file = os.path.join(spider.dir, 'autounit', 'server.json')
+
+            def read_output():
+                with open(output_path) as f:
+                    return f.read()
+
+            with open(output_path, 'w') as output:
+                proc = subprocess.Popen(
+                    ['autounit', 'serve'],
+                    env=env, cwd=spider.dir, stdout=output, stderr=subprocess.STDOUT)
+            try:
+                for _ in range(200):
+                    if 'Serving fixtures' in read_output():
+                        break
+                    time.sleep(0.1)
+                self.assertTrue(os.path.isfile(server_file), read_output())
+
+                out = spider.autounit('play', '-s', 'myspider')
+                self.assertIn('Played 3 fixture(s), 0 failed', out)
+                self.assertNotIn('Reloaded', read_output())
+
+                spider.parse("yield {'a': 1}")
+                spider._write_spider()
+                result = spider.autounit('play', '-s', 'myspider', check=False)
+                self.assertIn('Played 3 fixture(s), 3 failed', result)
+                self.assertIn('Reloaded: myproject.myspider', read_output())
+
+                spider.autounit('play', '--stop')
+                for _ in range(200):
+                    if proc.poll() is not None:
+                        break
+                    time.sleep(0.1)
+                self.assertEqual(proc.poll(), 0, read_output())
+                self.assertFalse(os.path.exists(server_file))
+            finally:
+                if proc.poll() is None:
+                    proc.terminate()
+                    proc.wait()
+
+    def test_watch_command(self):
+        with CaseSpider() as spider:
+            spider.start_requests("yield scrapy.Request('data:text/plain,')")
+            spider.parse("""
+                yield {'a': 1}
+                yield scrapy.Request('data:text/plain,1', callback=self.second_callback)
+            """)
+            spider.second_callback("yield {'b': 2}")
+            spider.record()
+            env = os.environ.copy()
+            env['PYTHONPATH'] = spider.dir
+            env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+            output_path = os.path.join(spider.dir, 'watch.log')
+
+            def wait_for(text):
+                for _ in range(200):
+                    with open(output_path) as f:
+                        if text in f.read():
+                            return
+                    time.sleep(0.1)
+                with open(output_path) as f:
+                    raise AssertionError('{!r} not found in:\n{}'.format(text, f.read()))
+
+            with open(output_path, 'w') as output:
+                proc = subprocess.Popen(
+                    ['autounit', 'watch', '-i', '0.1'],
+                    env=env, cwd=spider.dir, stdout=output, stderr=subprocess.STDOUT)
+            try:
+                wait_for('Watching for changes')
+                spider.second_callback("yield {'b': 3}")
+                spider._write_spider()
+                wait_for('Played 1 fixture(s), 1 failed')
+                with open(output_path) as f:
+                    output = f.read()
+                self.assertIn('FAILED autounit/tests/myspider/second_callback/', output)
+                self.assertNotIn('/parse/', output)
+            finally:
+                proc.terminate()
+                proc.wait()
+
+    def test_impact_command(self):
+        with CaseSpider() as spider:
+            with open(os.path.join(spider.proj_dir, 'middlewares.py'), 'w') as dest:
+                dest.write('class TagMiddleware(object):\n    pass\n')
+            spider.custom_settings("""
+                SPIDER_MIDDLEWARES_BASE={'myproject.middlewares.TagMiddleware': 960},
+            """)
+            spider.start_requests("yield scrapy.Request('data:text/plain,')")
+            spider.parse("""
+                yield {'a': 1}
+                yield scrapy.Request('data:text/plain,1', callback=self.second_callback)
+            """)
+            spider.second_callback("yield {'b': 2}")
+            spider.record(settings=dict(AUTOUNIT_RECORD_SETTINGS='DOWNLOAD_DELAY'))
+            manifest_path = os.path.join(spider.dir, 'autounit', 'manifest.json')
+            with open(manifest_path) as f:
+                entries = list(json.load(f)['fixtures'].values())
+            self.assertEqual(entries[0]['middlewares'], ['myproject.middlewares.TagMiddleware'])
+            self.assertEqual(entries[0]['settings'], ['DOWNLOAD_DELAY'])
+
+            parse = 'autounit/tests/myspider/parse/fixture1.bin'
+            second = 'autounit/tests/myspider/second_callback/fixture1.bin'
+            out = spider.autounit('impact', '-m', 'myproject.middlewares')
+            self.assertEqual(out.split(), [parse, second])
+            out = spider.autounit('impact', '-m', 'myproject.other')
+            self.assertEqual(out.split(), [])
+            out = spider.autounit('impact', '-S', 'DOWNLOAD_DELAY', '-s', 'myspider')
+            self.assertEqual(out.split(), [parse, second])
+            out = spider.autounit('impact', '-c', 'second_callback')
+            self.assertEqual(out.split(), [second])
+            out = spider.autounit('impact', '-c', 'parse', '--play')
+            self.assertIn('Played 1 fixture(s), 0 failed', out)
+
+            # Manifests written before middlewares were listed are completed
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for entry in manifest['fixtures'].values():
+                del entry['middlewares']
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+            out = spider.autounit('impact', '-m', 'myproject.middlewares.TagMiddleware')
+            self.assertEqual(out.split(), [parse, second])
+
+    def test_record_callbacks(self):
+        with CaseSpider() as spider:
+            spider.start_requests("yield scrapy.Request('data:text/plain,')")
+            spider.parse("""
+                yield scrapy.Request('data:text/plain,1', callback=self.second_callback)
+            """)
+            spider.second_callback("""
+                yield {'a': 4}
+            """)
+            spider.record(settings=dict(AUTOUNIT_RECORD_CALLBACKS='second_callback'))
+            tests_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider')
+            self.assertTrue(os.path.isdir(os.path.join(tests_dir, 'second_callback')))
+            self.assertFalse(os.path.isdir(os.path.join(tests_dir, 'parse')))
+            spider.test()
+
+    def test_unrecorded_callbacks_skip_cassettes(self):
+        from scrapy_autounit.cassette import Cassette
+
+        with CaseSpider() as spider:
+            spider.start_requests("yield scrapy.Request('data:text/plain,')")
+            spider.parse("""
+                return [scrapy.Request(
+                    'data:text/plain,1', callback=self.second_callback,
+                    meta={'recorded': '_autounit_cassette' in response.meta})]
+            """)
+            spider.second_callback("""
+                yield {'recorded': response.meta['recorded']}
+            """)
+            callback_dir = os.path.join(
+                spider.dir, 'autounit', 'tests', 'myspider', 'second_callback')
+            fixture = os.path.join(callback_dir, 'fixture1.bin')
+            spider.record()
+            cassette = Cassette.from_fixture(fixture)
+            self.assertEqual(cassette.output_data[0]['data'], {'recorded': True})
+            shutil.rmtree(os.path.join(spider.dir, 'autounit'))
+            spider.record(settings=dict(AUTOUNIT_DONT_RECORD_CALLBACKS='parse'))
+            cassette = Cassette.from_fixture(fixture)
+            self.assertEqual(cassette.output_data[0]['data'], {'recorded': False})
+
+    def test_recording_limits(self):
+        with CaseSpider() as spider:
+            spider.start_requests("yield scrapy.Request('data:text/plain,')")
+            spider.parse("""
+                yield {'a': 4}
+                yield scrapy.Request('data:text/plain,1', callback=self.second_callback)
+                yield scrapy.Request('data:text/plain,' + 'x' * 100, callback=self.parse)
+            """)
+            spider.second_callback("""
+                for i in range(5):
+                    yield {'b': i}
+            """)
+            spider.record(settings=dict(
+                AUTOUNIT_MAX_OUTPUT_ITEMS=3,
+                AUTOUNIT_MAX_BODY_SIZE=50,
+                AUTOUNIT_MEMORY_BUDGET=1,
+            ))
+            tests_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider')
+            self.assertFalse(os.path.isdir(os.path.join(tests_dir, 'second_callback')))
+            parse_dir = os.path.join(tests_dir, 'parse')
+            fixtures = [f for f in os.listdir(parse_dir) if f.endswith('.bin')]
+            self.assertEqual(fixtures, ['fixture1.bin'])
+            spider.test()
+
+    def test_concurrent_recording(self):
+        with CaseSpider() as spider:
+            spider.set_init("self.count = 0")
+            spider.start_requests("""
+                for i in range(20):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                self.count += 1
+                yield {'count': self.count}
+            """)
+            spider.record(settings=dict(
+                CONCURRENT_REQUESTS=16,
+                AUTOUNIT_TRACK_SPIDER_ATTRS=True,
+                AUTOUNIT_MAX_FIXTURES_PER_CALLBACK=20,
+            ))
+            self.assertEqual(spider.test(), 20)
+
+    def test_concurrent_recording_returned_output(self):
+        with CaseSpider() as spider:
+            spider.set_init("self.count = 0")
+            spider.start_requests("""
+                for i in range(20):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                self.count += 1
+                return [{'count': self.count}]
+            """)
+            spider.record(settings=dict(
+                CONCURRENT_REQUESTS=16,
+                AUTOUNIT_TRACK_SPIDER_ATTRS=True,
+                AUTOUNIT_MAX_FIXTURES_PER_CALLBACK=20,
+            ))
+            self.assertEqual(spider.test(), 20)
+
+    def test_stratified_sampling(self):
+        from scrapy_autounit.cassette import Cassette
+
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(30):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                if response.url.endswith(',7'):
+                    yield {'rare': response.url}
+                else:
+                    yield {'common': response.url}
+            """)
+            spider.record(settings=dict(AUTOUNIT_SAMPLING_STRATIFY_BY='shape'))
+            callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+            fixtures = [f for f in os.listdir(callback_dir) if f.endswith('.bin')]
+            self.assertEqual(len(fixtures), 10)
+            outputs = [
+                Cassette.from_fixture(os.path.join(callback_dir, f)).output_data[0]['data']
+                for f in fixtures
+            ]
+            self.assertEqual(sum(1 for out in outputs if 'rare' in out), 1)
+            spider.test()
+
+    def test_seeded_sampling(self):
+        from scrapy_autounit.cassette import Cassette
+
+        def recorded_fingerprints():
+            with CaseSpider() as spider:
+                spider.start_requests("""
+                    for i in range(30):
+                        yield scrapy.Request('data:text/plain,%s' % i)
+                """)
+                spider.parse("""
+                    yield {'a': response.url}
+                """)
+                spider.record(settings=dict(AUTOUNIT_SAMPLING_SEED='abc'))
+                callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+                return set(
+                    Cassette.from_fixture(os.path.join(callback_dir, f)).fingerprint
+                    for f in os.listdir(callback_dir) if f.endswith('.bin')
+                )
+
+        first = recorded_fingerprints()
+        self.assertEqual(len(first), 10)
+        self.assertEqual(first, recorded_fingerprints())
+
+    def test_merge_staged(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(int(self.start), int(self.start) + 8):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            settings = dict(
+                AUTOUNIT_STAGING=True,
+                AUTOUNIT_SAMPLING_SEED='abc',
+                AUTOUNIT_FIXTURE_NAMING_ATTR='start',
+                AUTOUNIT_MAX_FIXTURES_PER_CALLBACK=12,
+            )
+            # Overlapping requests, recorded by two processes
+            spider.record(args=dict(start=0), settings=settings, expect_tests=False)
+            spider.record(args=dict(start=4), settings=settings, expect_tests=False)
+            staging_dir = os.path.join(spider.dir, 'autounit', 'staging')
+            self.assertEqual(len(os.listdir(staging_dir)), 2)
+
+            out = spider.autounit('merge', '-j', '2')
+            # Kept up to the limit the crawls were run with
+            self.assertIn('Merged 16 fixture(s) from 2 process(es), 12 kept', out)
+            self.assertFalse(os.path.exists(staging_dir))
+            callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+            fixtures = [f for f in os.listdir(callback_dir) if f.endswith('.bin')]
+            self.assertEqual(len(fixtures), 12)
+            # Names keep the naming attribute and are renumbered
+            names = [re.match(r'^fixture_([04])_(\d+)\.bin$', f).groups() for f in fixtures]
+            self.assertEqual(set(start for start, _ in names), {'0', '4'})
+            self.assertEqual(sorted(int(index) for _, index in names), list(range(1, 13)))
+            self.assertEqual(spider.test(), 12)
+
+    def test_fixture_pack(self):
+        from scrapy_autounit.storage import Pack
+
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(30):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            spider.record(settings=dict(AUTOUNIT_FIXTURE_FORMAT='pack'))
+            callback_dir = os.path.join(spider.dir, 'autounit', 'tests', 'myspider', 'parse')
+            self.assertEqual(
+                sorted(os.listdir(callback_dir)),
+                ['__init__.py', 'fixtures.pack', 'test_fixtures.py'])
+            # Fixtures replaced while sampling are compacted away
+            self.assertEqual(Pack(os.path.join(callback_dir, 'fixtures.pack')).records, 10)
+            self.assertEqual(spider.test(), 10)
+            if HAS_PYTEST:
+                self.assertEqual(spider.pytest(), 10)
+            out = spider.autounit('play', '-s', 'myspider', '-c', 'parse', '-f', '3')
+            self.assertIn('Played 1 fixture(s), 0 failed', out)
+
+            spider.autounit('compact', '--format', 'files')
+            fixtures = [f for f in os.listdir(callback_dir) if f.endswith('.bin')]
+            self.assertEqual(len(fixtures), 10)
+            self.assertNotIn('fixtures.pack', os.listdir(callback_dir))
+            self.assertEqual(spider.test(), 10)
+
+    def test_fixture_pack_interrupted_write(self):
+        from scrapy_autounit.storage import Pack
+
+        callback_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(callback_dir, 'fixtures.pack')
+            pack = Pack(path)
+            pack.write('fixture1.bin', b'one')
+            # A record cut short after its header and part of its data
+            with open(path, 'ab') as f:
+                f.write(Pack.HEADER.pack(len('fixture2.bin'), 100) + b'fixture2.binpart')
+            pack = Pack(path)
+            self.assertEqual(sorted(pack.index), ['fixture1.bin'])
+            pack.write('fixture2.bin', b'two')
+            pack.write('fixture3.bin', b'three')
+            pack = Pack(path)
+            self.assertEqual(
+                [pack.read(name) for name in sorted(pack.index)], [b'one', b'two', b'three'])
+        finally:
+            shutil.rmtree(callback_dir)
+
+    def test_fixture_pack_cache(self):
+        from scrapy_autounit import storage
+
+        callback_dir = tempfile.mkdtemp()
+        try:
+            storage.write_fixture(os.path.join(callback_dir, 'fixture1.bin'), b'one', 'pack')
+            pack = storage.get_pack(callback_dir)
+            # Writes and deletes keep the cached pack, not just its index
+            storage.write_fixture(os.path.join(callback_dir, 'fixture2.bin'), b'two')
+            storage.delete_fixture(os.path.join(callback_dir, 'fixture1.bin'))
+            self.assertIs(storage.get_pack(callback_dir), pack)
+            self.assertEqual(sorted(pack.index), ['fixture2.bin'])
+            storage.compact(callback_dir)
+            self.assertIs(storage.get_pack(callback_dir), pack)
+            # Packs changed by other processes are read again
+            storage.Pack(pack.path).write('fixture3.bin', b'three')
+            self.assertEqual(
+                sorted(storage.get_pack(callback_dir).index), ['fixture2.bin', 'fixture3.bin'])
+        finally:
+            shutil.rmtree(callback_dir)
+
+    def test_fixture_database(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                for _ in range(int(response.text)):
+                    yield {'a': response.url}
+            """)
+            spider.record(settings=dict(AUTOUNIT_FIXTURE_FORMAT='sqlite'))
+            autounit_dir = os.path.join(spider.dir, 'autounit')
+            callback_dir = os.path.join(autounit_dir, 'tests', 'myspider', 'parse')
+            self.assertTrue(os.path.isfile(os.path.join(autounit_dir, 'fixtures.sqlite3')))
+            self.assertFalse(any(f.endswith('.bin') for f in os.listdir(callback_dir)))
+            self.assertEqual(spider.test(), 3)
+            if HAS_PYTEST:
+                self.assertEqual(spider.pytest(), 3)
+
+            out = spider.autounit('query', '-s', 'myspider', '-w', 'items > 0 AND status = 200')
+            fixtures = [json.loads(line) for line in out.splitlines()]
+            self.assertEqual(sorted(f['items'] for f in fixtures), [1, 2])
+            self.assertEqual(fixtures[0]['callback'], 'parse')
+            # Pool workers don't use the connection opened by the parent
+            out = spider.autounit('inspect', 'myspider', '-j', '2', '-F', 'request.url')
+            self.assertEqual(len(out.splitlines()), 3)
+
+            spider.autounit('update', '-s', 'myspider')
+            self.assertEqual(spider.test(), 3)
+            spider.autounit('compact', '--format', 'files')
+            fixtures = [f for f in os.listdir(callback_dir) if f.endswith('.bin')]
+            self.assertEqual(len(fixtures), 3)
+            self.assertEqual(spider.autounit('query'), '')
+
+    def test_json_serialization(self):
+        from scrapy_autounit.cassette import Cassette
+
+        with CaseSpider() as spider:
+            spider.imports("import datetime")
+            spider.start_requests("yield scrapy.Request('data:text/plain,')")
+            spider.parse("""
+                self.seen = {'a', 'b'}
+                yield {
+                    'bytes': b'\\x00\\xff',
+                    'tuple': (1, 'a'),
+                    'date': datetime.datetime(2020, 1, 2, 3, 4, 5),
+                    'keys': {1: 'a', b'b': 'c', '__type__': 'd'},
+                }
+            """)
+            spider.record(settings=dict(AUTOUNIT_SERIALIZATION='json'))
+            fixture = os.path.join(
+                spider.dir, 'autounit', 'tests', 'myspider', 'parse', 'fixture1.bin')
+            with open(fixture, 'rb') as f:
+                self.assertTrue(zlib.decompress(f.read()).startswith(b'{'))
+            self.assertEqual(Cassette.from_fixture(fixture).output_attrs['seen'], {'a', 'b'})
+            spider.test()
+
+            spider.autounit('convert', '--to', 'pickle')
+            self.assertEqual(Cassette.from_fixture(fixture).serialization, 'pickle')
+            spider.test()
+            spider.autounit('update', '-s', 'myspider')
+            self.assertEqual(Cassette.from_fixture(fixture).serialization, 'pickle')
+
+    def test_json_items_and_pickle_refused(self):
+        import sys
+        from scrapy_autounit import serialization
+
+        # Modules named by fixtures are not imported
+        with self.assertRaisesRegexp(ValueError, 'not a known item class'):
+            serialization._decode_item({'class': 'this.Item', 'fields': {}})
+        self.assertNotIn('this', sys.modules)
+
+        with CaseSpider() as spider:
+            spider.imports("""
+class MyItem(scrapy.Item):
+    name = scrapy.Field()
+            """)
+            spider.start_requests("""
+                yield scrapy.Request('data:text/plain,1')
+                yield scrapy.Request('data:text/plain,2', callback=self.second_callback)
+            """)
+            spider.parse("yield MyItem(name=response.url)")
+            spider.second_callback("yield MyItem(name=response.url)")
+            spider.record(settings=dict(AUTOUNIT_SERIALIZATION='json'))
+            with open(os.path.join(spider.proj_dir, 'settings.py'), 'a') as f:
+                f.write('AUTOUNIT_ALLOW_PICKLE = False\n')
+            self.assertEqual(spider.test(), 2)
+
+            spider.autounit('convert', '--to', 'pickle')
+            with self.assertRaisesRegexp(AssertionError, 'AUTOUNIT_ALLOW_PICKLE'):
+                spider.test()
+
+    def test_inspect_command(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(3):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            spider.record()
+            out = spider.autounit('inspect', 'myspider', 'parse', '2')
+            self.assertEqual(json.loads(out)['response']['body'], '1')
+
+            out = spider.autounit(
+                'inspect', 'myspider', '-j', '2',
+                '-F', 'request.url', '-F', 'output_data[*].type')
+            fixtures = [json.loads(line) for line in out.splitlines()]
+            self.assertEqual(len(fixtures), 3)
+            self.assertEqual(fixtures[1], {
+                'fixture': os.path.join('autounit', 'tests', 'myspider', 'parse', 'fixture2.bin'),
+                'request.url': 'data:text/plain,1',
+                'output_data[*].type': ['item'],
+            })
+
+    def test_diff_command(self):
+        with CaseSpider() as spider:
+            spider.start_requests("""
+                for i in range(4):
+                    yield scrapy.Request('data:text/plain,%s' % i)
+                # Recorded twice, with the same fingerprint
+                yield scrapy.Request('data:text/plain,3', dont_filter=True)
+            """)
+            spider.parse("""
+                yield {'a': response.url}
+            """)
+            spider.record()
+            autounit_dir = os.path.join(spider.dir, 'autounit')
+            shutil.copytree(autounit_dir, os.path.join(spider.dir, 'old'))
+
+            spider.parse("""
+                yield {'a': response.url, 'b': 1 if response.text == '2' else None}
+                if response.text == '3':
+                    self.seen = True
+            """)
+            spider.record()
+            out = spider.autounit('diff', 'old', 'autounit', check=False)
+            self.assertIn('0 identical, 0 with the same output, 5 changed', out)
+            self.assertIn("  + output_data[0].data.b: 1", out)
+            self.assertIn("  + output_attrs.seen: true", out)
+
+            out = spider.autounit('diff', '-j', '1', 'autounit', 'autounit')
+            self.assertIn('5 identical, 0 with the same output, 0 changed', out)
+
+    def test_replay_cassette(self):
+        with CaseSpider() as spider:
+            spider.start_requests("yield scrapy.Request('data:text/plain,abc')")
+            spider.parse("""
+                response.meta['seen'] = True
+                assert not response.flags
+                response.flags.append('seen')
+                self.values = getattr(self, 'values', []) + [response.text]
+                yield {'a': response.text}
+            """)
+            spider.record(settings=dict(
+                AUTOUNIT_DONT_TEST_OUTPUT_FIELDS=['a'],
+                AUTOUNIT_RECORD_SETTINGS=['AUTOUNIT_DONT_TEST_OUTPUT_FIELDS']))
+            fixture = os.path.join(
+                spider.dir, 'autounit', 'tests', 'myspider', 'parse', 'fixture1.bin')
+            env = os.environ.copy()
+            env['PYTHONPATH'] = spider.dir
+            env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+            result = run(
+                ['python', '-c', (
+                    'import sys\n'
+                    'from scrapy_autounit.cassette import Cassette\n'
+                    'from scrapy_autounit.player import Player\n'
+                    'cassette = Cassette.from_fixture(sys.argv[1])\n'
+                    'for _ in range(3):\n'
+                    '    Player(cassette).playback()\n'
+                    'assert cassette.response["cls"]\n'
+                    'assert "seen" not in cassette.request["meta"]\n'
+                    'assert cassette.output_data[0]["data"]["a"] == "abc"\n'
+                ), fixture],
+                env=env,
+                cwd=spider.dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            check_process('Replaying cassette failed!', result)
+
+    def test_selector_cache(self):
+        with CaseSpider() as spider:
+            spider.start_requests(
+                "yield scrapy.Request('data:text/html,<title>a</title><p>b</p>')")
+            spider.parse("""
+                yield {
+                    'title': response.css('title::text').get(),
+                    'p': response.xpath('//p/text()').get(),
+                }
+            """)
+            spider.custom_settings("AUTOUNIT_SELECTOR_CACHE_SIZE=10 ** 6,")
+            spider.record()
+            fixture = os.path.join(
+                spider.dir, 'autounit', 'tests', 'myspider', 'parse', 'fixture1.bin')
+            env = os.environ.copy()
+            env['PYTHONPATH'] = spider.dir
+            env['SCRAPY_SETTINGS_MODULE'] = 'myproject.settings'
+            result = run(
+                ['python', '-c', (
+                    'import sys\n'
+                    'from scrapy_autounit import cache\n'
+                    'from scrapy_autounit.player import Player\n'
+                    'for _ in range(3):\n'
+                    '    Player.from_fixture(sys.argv[1]).playback()\n'
+                    'assert (cache._selector_cache.misses, cache._selector_cache.hits) == (1, 2)\n'
+                ), fixture],
+                env=env,
+                cwd=spider.dir,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            check_process('Replaying with the selector cache failed!', result)
+
     def test_path_extra(self):
         with CaseSpider() as spider:
             spider.start_requests("yield scrapy.Request('data:text/plain,')")